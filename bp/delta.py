@@ -0,0 +1,138 @@
+# Copyright (C) 2014 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+rsync-style delta encoding of files against an existing copy.
+
+A "basis" file is cut into fixed-size blocks, each of which is summarized by
+a weak, rolling checksum and a strong digest. The new version of the file is
+then scanned with a window which is rolled one byte at a time, so that blocks
+of the basis are recognized wherever they appear in the new file, even after
+insertions or deletions have shifted them around.
+"""
+
+from hashlib import md5
+from zlib import adler32
+
+# The modulus of Adler-32.
+_BASE = 65521
+
+
+def blockSignatures(basis, blockSize):
+    """
+    Summarize every whole block of a basis file.
+
+    :param basis: A file-like object, positioned at the start of the basis.
+    :param int blockSize: The size of each block, in bytes.
+
+    :return: A dict mapping weak checksums to dicts mapping strong digests to
+             block indices.
+    :rtype: dict
+    """
+
+    signatures = {}
+    index = 0
+    while True:
+        block = basis.read(blockSize)
+        if len(block) < blockSize:
+            break
+        weak = adler32(block) & 0xffffffff
+        signatures.setdefault(weak, {}).setdefault(md5(block).digest(), index)
+        index += 1
+    return signatures
+
+
+def computeDelta(source, signatures, blockSize):
+    """
+    Encode a file as a series of basis blocks and literal data.
+
+    :param source: A file-like object holding the new version of the file.
+    :param dict signatures: The signatures of the basis, as returned by
+                            :py:func:`blockSignatures`.
+    :param int blockSize: The block size the signatures were computed with.
+
+    :return: An iterator yielding either L{int} indices of basis blocks or
+             L{bytes} of literal data, which together make up C{source}.
+    """
+
+    buf = bytearray()
+    # The start of the window, and the start of any pending literal data.
+    pos = literal = 0
+    eof = False
+    a = b = None
+
+    while True:
+        # Rolling needs one byte past the end of the window.
+        if len(buf) - pos <= blockSize and not eof:
+            if pos > literal:
+                yield bytes(buf[literal:pos])
+            del buf[:pos]
+            pos = literal = 0
+            chunk = source.read(blockSize * 4)
+            if chunk:
+                buf.extend(chunk)
+            else:
+                eof = True
+            continue
+
+        if len(buf) - pos < blockSize:
+            break
+
+        if a is None:
+            weak = adler32(bytes(buf[pos:pos + blockSize])) & 0xffffffff
+            a, b = weak & 0xffff, weak >> 16
+        else:
+            weak = (b << 16) | a
+
+        candidates = signatures.get(weak)
+        if candidates:
+            index = candidates.get(md5(buf[pos:pos + blockSize]).digest())
+            if index is not None:
+                if pos > literal:
+                    yield bytes(buf[literal:pos])
+                yield index
+                pos += blockSize
+                literal = pos
+                a = b = None
+                continue
+
+        if len(buf) - pos == blockSize:
+            # Nothing left to roll in.
+            break
+
+        out, new = buf[pos], buf[pos + blockSize]
+        a = (a - out + new) % _BASE
+        b = (b - blockSize * out + a - 1) % _BASE
+        pos += 1
+
+    if len(buf) > literal:
+        yield bytes(buf[literal:])
+
+
+def patch(basis, instructions, target, blockSize):
+    """
+    Reassemble a file from a basis and a delta.
+
+    :param basis: A seekable file-like object holding the basis.
+    :param instructions: An iterable of instructions, as yielded by
+                         :py:func:`computeDelta`.
+    :param target: A file-like object to write the reassembled file to.
+    :param int blockSize: The block size the delta was computed with.
+    """
+
+    for instruction in instructions:
+        if isinstance(instruction, bytes):
+            target.write(instruction)
+        else:
+            basis.seek(instruction * blockSize)
+            target.write(basis.read(blockSize))
@@ -25,6 +25,7 @@ import base64
 import errno
 from hashlib import sha1
 import os
+import sys
 
 from os.path import isabs, exists, normpath, abspath, splitext
 from os.path import basename, dirname
@@ -48,6 +49,7 @@ from bp.errors import LinkError, UnlistableError
 from bp.generic import (genericChildren, genericDescendant, genericGetContent,
                         genericParents, genericSegmentsFrom, genericSibling,
                         genericWalk)
+from bp.util import parallelMap
 from bp.win32 import (ERROR_FILE_NOT_FOUND, ERROR_PATH_NOT_FOUND,
                       ERROR_INVALID_NAME, ERROR_DIRECTORY, O_BINARY,
                       isWindows, WindowsError)
@@ -59,6 +61,70 @@ _CREATE_FLAGS = (os.O_EXCL |
                  O_BINARY)
 
 
+# lseek(2) whence values for finding the data extents of sparse files. Python
+# only learned their names in 3.3, but Linux has had them since 3.1.
+if hasattr(os, 'SEEK_DATA'):
+    _SEEK_DATA, _SEEK_HOLE = os.SEEK_DATA, os.SEEK_HOLE
+elif sys.platform.startswith('linux'):
+    _SEEK_DATA, _SEEK_HOLE = 3, 4
+else:
+    _SEEK_DATA = _SEEK_HOLE = None
+
+
+def _copySparse(readfile, writefile, chunkSize):
+    """
+    Copy a sparse file, preserving its holes.
+
+    Nothing is copied if the source is not sparse, or if holes cannot be
+    found on this platform or filesystem.
+
+    :param readfile: The source, an open L{file}.
+    :param writefile: The destination, an open and empty L{file}.
+    :param int chunkSize: The largest number of bytes to read at once.
+
+    :return: C{True} if the file was copied, C{False} if it should instead
+             be copied normally.
+    :rtype: L{bool}
+    """
+    if _SEEK_DATA is None:
+        return False
+    try:
+        fd = readfile.fileno()
+    except AttributeError:
+        return False
+    st = os.fstat(fd)
+    size = st.st_size
+    # A file whose allocated blocks cover its whole size has no holes.
+    if getattr(st, 'st_blocks', size) * 512 >= size:
+        return False
+
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, _SEEK_DATA)
+        except OSError as ose:
+            if ose.errno == errno.ENXIO:
+                # Nothing but a hole from here to the end.
+                break
+            elif ose.errno == errno.EINVAL and offset == 0:
+                # The filesystem can't tell us where the holes are.
+                return False
+            raise
+        end = os.lseek(fd, start, _SEEK_HOLE)
+        os.lseek(fd, start, os.SEEK_SET)
+        writefile.seek(start)
+        while start < end:
+            chunk = os.read(fd, min(chunkSize, end - start))
+            if not chunk:
+                break
+            writefile.write(chunk)
+            start += len(chunk)
+        offset = end
+    # Extend the destination over any trailing hole.
+    writefile.truncate(size)
+    return True
+
+
 def _stub_islink(path):
     """
     Always return C{False} if the operating system does not support symlinks.
@@ -93,6 +159,56 @@ def _secureEnoughString():
     return armor(sha1(randomBytes(64)).digest())[:16]
 
 
+def _fileDigest(fp):
+    """
+    Compute a digest of the contents of a file.
+
+    :param FilePath fp: The file to digest.
+
+    :return: The SHA-1 digest of the file's contents.
+    :rtype: C{bytes}
+    """
+    digest = sha1()
+    f = fp.open()
+    try:
+        while True:
+            chunk = f.read(FilePath._chunkSize)
+            if not chunk:
+                break
+            digest.update(chunk)
+    finally:
+        f.close()
+    return digest.digest()
+
+
+# How far apart, in seconds, two modification times may be and still be
+# considered the same.
+_MTIME_TOLERANCE = 1e-5
+
+
+def _filesDiffer(source, destination, checksum=False):
+    """
+    Determine whether a destination file needs to be refreshed from a source
+    file.
+
+    :param bool checksum: Whether to compare contents by digest instead of
+                          comparing modification times.
+
+    :return: C{True} if C{destination} is missing or differs from C{source}.
+    :rtype: L{bool}
+    """
+    if not destination.isfile():
+        return True
+    if source.getsize() != destination.getsize():
+        return True
+    if checksum:
+        return _fileDigest(source) != _fileDigest(destination)
+    # utime() can only store microseconds, so a copy's modification time
+    # may differ from its source's by a little.
+    return abs(source.getModificationTime() -
+               destination.getModificationTime()) > _MTIME_TOLERANCE
+
+
 class RWX(namedtuple("RWX", "read, write, execute")):
     """
     A class representing read/write/execute permissions for a single user
@@ -166,6 +282,86 @@ class Permissions(namedtuple("Permissions", "user, group, other")):
             [x.shorthand() for x in (self.user, self.group, self.other)])
 
 
+class DiskUsage(namedtuple("DiskUsage", "size, files, directories, errors")):
+    """
+    A summary of the disk space used by a tree of files, as returned by
+    L{FilePath.diskUsage}.
+
+    @type size: C{int}
+    @ivar size: The number of bytes used by the whole tree
+
+    @type files: C{int}
+    @ivar files: The number of distinct non-directory files in the tree
+
+    @type directories: C{dict}
+    @ivar directories: A mapping from the L{FilePath} of each directory in
+        the tree to the number of bytes used by it and everything beneath it
+
+    @type errors: C{list}
+    @ivar errors: The L{FilePath}s of entries which could not be examined or
+        directories which could not be listed, and so were left out
+    """
+
+
+def _entrySize(st, apparent):
+    """
+    Compute the number of bytes a file takes up.
+
+    :param st: The result of L{os.lstat} on the file.
+    :param bool apparent: Whether to use the file's size, rather than the
+                          space allocated to it.
+    """
+    if apparent or not hasattr(st, 'st_blocks'):
+        return st.st_size
+    return st.st_blocks * 512
+
+
+def _scanDirectory(path, apparent):
+    """
+    Measure the entries of a single directory, without descending into it.
+
+    :param bytes path: The directory to scan.
+    :param bool apparent: See L{_entrySize}.
+
+    Entries which vanish or can't be examined, and the directory itself if
+    it can't be listed, are left out and reported rather than failing the
+    whole scan, as C{du} does.
+
+    :return: A tuple of the path, the number of bytes used by the directory
+             itself and those of its files which have only one link, the
+             number of such files, a list of C{(device, inode, size)} tuples
+             for files with several links, a list of the paths of
+             subdirectories, and a list of the paths which couldn't be
+             examined or listed.
+    """
+    size = 0
+    files = 0
+    linked = []
+    subdirs = []
+    errors = []
+    try:
+        size = _entrySize(os.lstat(path), apparent)
+        names = listdir(path)
+    except OSError:
+        errors.append(path)
+        names = []
+    for name in names:
+        child = joinpath(path, name)
+        try:
+            st = os.lstat(child)
+        except OSError:
+            errors.append(child)
+            continue
+        if S_ISDIR(st.st_mode):
+            subdirs.append(child)
+        elif st.st_nlink > 1:
+            linked.append((st.st_dev, st.st_ino, _entrySize(st, apparent)))
+        else:
+            size += _entrySize(st, apparent)
+            files += 1
+    return path, size, files, linked, subdirs, errors
+
+
 @implementer(IFilePath)
 class FilePath(object):
     """
@@ -1041,7 +1237,8 @@ class FilePath(object):
 
     _chunkSize = 2 ** 2 ** 2 ** 2
 
-    def copyTo(self, destination, followLinks=True):
+    def copyTo(self, destination, followLinks=True, delta=False,
+               hardLinks=False):
         """
         Copies self to destination.
 
@@ -1056,6 +1253,10 @@ class FilePath(object):
         destination is a file, this method overwrites it.  If destination is a
         directory, an IOError will be raised.
 
+        Sparse files are copied sparsely where the platform can report where
+        their data lies: only the data extents are read and written, and the
+        holes between them are left as holes in destination.
+
         If self is a link (and followLinks is False), self will be copied over
         as a new symlink with the same target as returned by os.readlink.
         That means that if it is absolute, both the old and new symlink will
@@ -1077,6 +1278,24 @@ class FilePath(object):
                                      self should be copied
         :param bool followLinks: whether symlinks in self should be treated as
                                  links or as their targets
+        :param bool delta: whether files which already exist at destination
+                           should be updated with a delta copy; see
+                           :py:meth:`.deltaCopyTo`
+        :param bool hardLinks: whether files under self which are hard links
+                               to each other should be copied as hard links to
+                               each other; otherwise, each link is copied as
+                               an independent file
+        """
+        links = {} if hardLinks and not isWindows else None
+        self._copyTo(destination, followLinks, delta, links)
+
+    def _copyTo(self, destination, followLinks, delta, links):
+        """
+        Copy self to destination, as described by :py:meth:`.copyTo`.
+
+        :param dict links: if hard links are being preserved, a dict mapping
+                           the device and inode numbers of files already
+                           copied to their copies; otherwise, C{None}
         """
         if self.islink() and not followLinks:
             os.symlink(os.readlink(self.path), destination.path)
@@ -1090,35 +1309,261 @@ class FilePath(object):
                 destination.createDirectory()
             for child in self.children():
                 destChild = destination.child(child.basename())
-                child.copyTo(destChild, followLinks)
+                child._copyTo(destChild, followLinks, delta, links)
         elif self.isfile():
-            writefile = destination.open('w')
+            key = None
+            if links is not None and self.getNumberOfHardLinks() > 1:
+                key = self.getDevice(), self.getInodeNumber()
+                if key in links:
+                    # Another link to this file has already been copied;
+                    # link to that copy instead of copying the data again.
+                    if destination.exists():
+                        destination.remove()
+                    os.link(links[key].path, destination.path)
+                    destination.changed()
+                    return
+            if (delta and destination.isfile() and
+                    (links is None or
+                     destination.getNumberOfHardLinks() == 1)):
+                # An updated copy linked to other files would change those
+                # too, so with hardLinks it is only updated in place if it
+                # has no other links.
+                self.deltaCopyTo(destination)
+            else:
+                if links is not None and destination.isfile():
+                    # An earlier copy may have linked destination to other
+                    # files, which writing into it would change too.
+                    destination.remove()
+                self._copyContentTo(destination)
+            if key is not None:
+                links[key] = destination
+        elif not self.exists():
+            raise OSError(errno.ENOENT, "No such file or directory")
+        else:
+            # If you see the following message because you want to copy
+            # symlinks, fifos, block devices, character devices, or unix
+            # sockets, please feel free to add support to do sensible things in
+            # reaction to those types!
+            raise NotImplementedError(
+                "Only copying of files and directories supported")
+
+    def _copyContentTo(self, destination):
+        """
+        Copy the bytes of self, which must be a file, to destination.
+        """
+        writefile = destination.open('w')
+        try:
+            readfile = self.open()
             try:
-                readfile = self.open()
-                try:
+                if not _copySparse(readfile, writefile, self._chunkSize):
                     while True:
                         # XXX TODO: optionally use os.open, os.read and
                         # O_DIRECT and use os.fstatvfs to determine chunk
                         # sizes and make *****sure**** copy is page-atomic;
-                        # the following is good enough for 99.9% of everybody
-                        # and won't take a week to audit though.
+                        # the following is good enough for 99.9% of
+                        # everybody and won't take a week to audit though.
                         chunk = readfile.read(self._chunkSize)
                         writefile.write(chunk)
                         if len(chunk) < self._chunkSize:
                             break
-                finally:
-                    readfile.close()
+            finally:
+                readfile.close()
+        finally:
+            writefile.close()
+
+    def deltaCopyTo(self, destination):
+        """
+        Copy self, which must be a file, over the file at destination,
+        writing only those blocks of destination which differ from self.
+
+        Both files are read side by side, a block at a time, and each block
+        of destination is rewritten in place only if it differs from the
+        block at the same offset in self; destination is then truncated or
+        extended to the size of self.  Unchanged blocks are never written,
+        so a large file which changes in a few small regions costs two reads
+        and a handful of writes rather than a complete rewrite.
+
+        This only pays off when changes leave the rest of the file where it
+        was.  Bytes inserted or removed shift every later block, which then
+        all differ, and the whole tail is written as with
+        :py:meth:`.copyTo`.
+
+        Since destination is updated in place, an interrupted copy leaves it
+        partly updated, and any other hard links to destination see the new
+        contents too.  If destination does not exist, self is simply copied.
+
+        :param FilePath destination: the file to update
+        """
+        if not destination.isfile():
+            self.copyTo(destination)
+            return
+
+        blockSize = self._chunkSize
+        readfile = self.open()
+        try:
+            writefile = destination.open('r+')
+            try:
+                offset = 0
+                while True:
+                    chunk = readfile.read(blockSize)
+                    if not chunk:
+                        break
+                    if writefile.read(len(chunk)) != chunk:
+                        writefile.seek(offset)
+                        writefile.write(chunk)
+                    offset += len(chunk)
+                    # Switching from writing to reading needs a seek, and
+                    # this also skips any short read of destination.
+                    writefile.seek(offset)
+                writefile.truncate(offset)
             finally:
                 writefile.close()
-        elif not self.exists():
+        finally:
+            readfile.close()
+        destination.changed()
+
+    def diskUsage(self, apparent=False, workers=1):
+        """
+        Measure the disk space used by this path and, if it is a directory,
+        by everything beneath it, in the manner of C{du}.
+
+        Directories are scanned a level at a time, and the directories of each
+        level are spread across a pool of threads; each entry is examined
+        with a single C{lstat()}.  Symlinks are not followed, and a file with
+        several hard links in the tree is only counted once.  Entries which
+        can't be examined and directories which can't be listed are left out
+        and reported, and the rest of the tree is still measured.
+
+        :param bool apparent: whether to count the sizes of files, rather
+                              than the disk space allocated to them
+        :param int workers: the number of threads to scan directories with
+
+        :return: the total usage, and the usage of each directory
+        :rtype: :py:class:`DiskUsage`
+        """
+        if not self.isdir() or self.islink():
+            st = os.lstat(self.path)
+            return DiskUsage(_entrySize(st, apparent), 1, {}, [])
+
+        def scan(path):
+            return _scanDirectory(path, apparent)
+
+        order = []
+        sizes = {}
+        files = 0
+        seen = set()
+        errors = []
+        frontier = [self.path]
+        while frontier:
+            subdirs = []
+            for path, size, count, linked, children, failed in parallelMap(
+                    scan, frontier, workers):
+                for device, inode, linkedSize in linked:
+                    if (device, inode) not in seen:
+                        seen.add((device, inode))
+                        size += linkedSize
+                        count += 1
+                order.append(path)
+                sizes[path] = size
+                files += count
+                subdirs.extend(children)
+                errors.extend(failed)
+            frontier = subdirs
+
+        # Every directory was scanned after its parent, so walking backwards
+        # accumulates each subtree before its total is needed.
+        for path in reversed(order[1:]):
+            sizes[dirname(path)] += sizes[path]
+
+        directories = dict((self.clonePath(path), size)
+                           for path, size in sizes.iteritems())
+        return DiskUsage(sizes[self.path], files, directories,
+                         [self.clonePath(path) for path in errors])
+
+    def syncTo(self, destination, delete=False, checksum=False, delta=False,
+               workers=1):
+        """
+        Make destination a mirror of self, copying only what has changed.
+
+        If self is a directory, the two trees are compared entry by entry.
+        Files which are missing from destination, or which differ from their
+        counterpart, are copied; everything else is left alone, so the cost
+        of a sync is proportional to the amount of changed data rather than
+        to the size of the tree.  If self is a file, it is copied to
+        destination only if the two differ.
+
+        Files are considered to differ if their sizes or modification times
+        differ, using cached stat information where available.  If checksum
+        is True, files of the same size are instead compared by digest, which
+        is slower but immune to clock skew and timestamp-preserving edits.
+        Copied files have their modification times set to match their
+        sources, so that later syncs can recognize them as unchanged.
+
+        An entry whose kind differs between the two trees (for example, a file
+        in self and a directory in destination) is removed from destination
+        and replaced.
+
+        As with :py:meth:`.copyTo`, symlinks in self are followed, and
+        permissions and ownership are not copied.
+
+        :param FilePath destination: the destination to mirror self into
+        :param bool delete: whether entries in destination which do not exist
+                            in self should be removed
+        :param bool checksum: whether files should be compared by digest
+                              rather than by modification time
+        :param bool delta: whether changed files which already exist at
+                           destination should be updated with
+                           :py:meth:`.deltaCopyTo`
+        :param int workers: the number of threads to copy files with
+        """
+        if not self.exists():
             raise OSError(errno.ENOENT, "No such file or directory")
+
+        pending = []
+        self._planSync(destination, delete, checksum, pending)
+
+        def copy(pair):
+            source, target = pair
+            source.copyTo(target, delta=delta)
+            utime(target.path, (source.getAccessTime(),
+                                source.getModificationTime()))
+            target.changed()
+
+        parallelMap(copy, pending, workers)
+
+    def _planSync(self, destination, delete, checksum, pending):
+        """
+        Bring the directory structure of destination in line with self, and
+        collect the files which need to be copied into it.
+
+        :param list pending: a list which (source, destination) pairs of
+                             files needing copying are appended to
+        """
+        # Syncing through a symlink in destination would change whatever it
+        # points to, so links are replaced rather than followed.
+        if self.isdir():
+            if destination.islink() or (destination.exists()
+                                        and not destination.isdir()):
+                destination.remove()
+            if not destination.exists():
+                destination.createDirectory()
+            names = self.listdir()
+            if delete:
+                keep = set(names)
+                for name in destination.listdir():
+                    if name not in keep:
+                        destination.child(name).remove()
+            for name in names:
+                self.child(name)._planSync(destination.child(name), delete,
+                                           checksum, pending)
+        elif self.isfile():
+            if destination.islink() or destination.isdir():
+                destination.remove()
+            if _filesDiffer(self, destination, checksum):
+                pending.append((self, destination))
         else:
-            # If you see the following message because you want to copy
-            # symlinks, fifos, block devices, character devices, or unix
-            # sockets, please feel free to add support to do sensible things in
-            # reaction to those types!
-            raise NotImplementedError(
-                "Only copying of files and directories supported")
+            # Let copyTo decide what to do with anything exotic.
+            pending.append((self, destination))
 
     def moveTo(self, destination, followLinks=True):
         """
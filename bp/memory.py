@@ -11,8 +11,20 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
-from itertools import chain
+from collections import namedtuple
+from contextlib import contextmanager
+import errno
+from hashlib import sha1
+from itertools import count
+import mmap
+import os
+from stat import S_ISDIR, S_ISLNK, S_ISREG
 from StringIO import StringIO
+import struct
+import sys
+from threading import Lock, RLock
+import zlib
+from uuid import uuid4
 
 from zope.interface import implementer
 
@@ -20,19 +32,55 @@ from bp.abstract import IFilePath
 from bp.errors import UnlistableError
 from bp.generic import (genericChildren, genericParents, genericSegmentsFrom,
                         genericSibling, genericWalk)
+from bp.util import (OrderedDict, encodeName, ensureDirectory,
+                     modeIsWriting, parallelMap)
 
 DIR = object()
 FILE = object()
 
+# The layout of a saved MemoryFS image: a header giving the number of entries
+# and where the data begins, then an entry for each directory and file, and
+# then the contents of the files. Each entry gives its whole path, encoded as
+# UTF-8 where it is unicode, and is flagged if its own name was unicode; the
+# names above it are those of the directory entries which come before it.
+_IMAGE_MAGIC = b"BPMEMFS1"
+_IMAGE_HEADER = struct.Struct("<8sQQ")
+_IMAGE_ENTRY = struct.Struct("<BIQQ")
+_IMAGE_DIR, _IMAGE_FILE = 0, 1
+_IMAGE_UNICODE = 2
 
-class MemoryFile(StringIO):
+# How many locks to share out between the files of a MemoryFS.
+_STRIPES = 32
+
+try:
+    memoryview
+except NameError:
+    # Python 2.6 only has the older buffer interface.
+    def _slice(buf, start, end):
+        return bytes(buffer(buf, start, end - start))
+else:
+    def _slice(buf, start, end):
+        return memoryview(buf)[start:end].tobytes()
+
+
+class MemoryFile(object):
     """
-    A file-like object that saves itself to an external mapping when closed.
+    A writable file-like object which works directly on the bytearray holding
+    a file in a MemoryFS.
+
+    Writes land in place, so appending is amortized constant-time and nothing
+    needs to be copied back when the file is closed.
     """
 
-    def __init__(self, store, key, buf=""):
-        StringIO.__init__(self, buf)
-        self._target = store, key
+    def __init__(self, fs, key, buf, mode="w"):
+        self._fs = fs
+        self._key = key
+        self._buf = buf
+        self._token = fs._token
+        self._append = "a" in mode
+        self._readable = "r" in mode or "+" in mode
+        self._pos = len(buf) if self._append else 0
+        self.closed = False
 
     def __enter__(self):
         return self
@@ -40,29 +88,1490 @@ class MemoryFile(StringIO):
     def __exit__(self, *exc_info):
         self.close()
 
+    def __iter__(self):
+        return self
+
+    def _checkOpen(self):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+
+    def _checkReadable(self):
+        self._checkOpen()
+        if not self._readable:
+            raise IOError(errno.EBADF, "File not open for reading")
+
+    def _writable(self):
+        """
+        Get the buffer to write to. If the filesystem has been forked since
+        this file was opened, the buffer may be shared with the fork, and is
+        copied first.
+        """
+
+        if self._token is not self._fs._token:
+            self._buf = self._fs._writableContent(self._key)
+            self._token = self._fs._token
+        return self._buf
+
+    def _take(self, end):
+        start = self._pos
+        if end <= start:
+            return b""
+        self._pos = end
+        return _slice(self._buf, start, end)
+
+    def read(self, size=-1):
+        self._checkReadable()
+        with self._fs._lockFor(self._key):
+            end = len(self._buf)
+            if size >= 0:
+                end = min(end, self._pos + size)
+            return self._take(end)
+
+    def readline(self, size=-1):
+        self._checkReadable()
+        with self._fs._lockFor(self._key):
+            end = self._buf.find(b"\n", self._pos)
+            end = len(self._buf) if end == -1 else end + 1
+            if size >= 0:
+                end = min(end, self._pos + size)
+            return self._take(end)
+
+    def readlines(self):
+        return list(self)
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def write(self, data):
+        self._checkOpen()
+        self._fs._tally("writes", self._key)
+        with self._fs._lockFor(self._key):
+            buf = self._writable()
+            if self._append:
+                self._pos = len(buf)
+            pos = self._pos
+            before = len(buf)
+            if pos > before:
+                buf.extend(b"\0" * (pos - before))
+            buf[pos:pos + len(data)] = data
+            self._pos = pos + len(data)
+            if len(buf) != before:
+                self._fs._resized(self._key, buf, len(buf) - before)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def seek(self, offset, whence=0):
+        self._checkOpen()
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += len(self._buf)
+        if offset < 0:
+            raise IOError(errno.EINVAL, "Invalid argument")
+        self._pos = offset
+
+    def tell(self):
+        self._checkOpen()
+        return self._pos
+
+    def truncate(self, size=None):
+        self._checkOpen()
+        if size is None:
+            size = self._pos
+        with self._fs._lockFor(self._key):
+            buf = self._writable()
+            before = len(buf)
+            if size < before:
+                del buf[size:]
+            else:
+                buf.extend(b"\0" * (size - before))
+            if len(buf) != before:
+                self._fs._resized(self._key, buf, len(buf) - before)
+
+    def flush(self):
+        self._checkOpen()
+
     def close(self):
-        buf = self.getvalue()
-        store, key = self._target
-        store[key] = buf
-        StringIO.close(self)
+        if not self.closed:
+            self.closed = True
+            with self._fs._lockFor(self._key):
+                self._fs._release(self._key)
+
+
+class MemoryReadFile(StringIO):
+    """
+    A read-only file-like object over the contents of a file in a MemoryFS.
+
+    The contents are shared with the filesystem rather than copied, and
+    nothing is written back when the file is closed.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, s):
+        raise IOError(errno.EBADF, "File not open for writing")
+
+    def truncate(self, size=None):
+        raise IOError(errno.EBADF, "File not open for writing")
+
+
+class _Directory(object):
+    """
+    A directory in a MemoryFS, mapping the names of its children to their
+    nodes.
+
+    Nodes may be shared between forks of a filesystem; a filesystem only
+    modifies the nodes it owns, and copies any others before changing them.
+    """
+
+    __slots__ = "owner", "entries"
+
+    def __init__(self, owner, entries=None):
+        self.owner = owner
+        self.entries = {} if entries is None else entries
+
+    def clone(self, owner):
+        return _Directory(owner, dict(self.entries))
+
+
+class _File(object):
+    """
+    A file in a MemoryFS.
+
+    The contents are either a string, which may be shared freely, or a
+    bytearray which writable handles modify in place.
+    """
+
+    __slots__ = "owner", "content"
+
+    def __init__(self, owner, content):
+        self.owner = owner
+        self.content = content
+
+    def clone(self, owner):
+        content = self.content
+        if isinstance(content, bytearray):
+            content = bytearray(content)
+        return _File(owner, content)
+
+
+class _Deferred(object):
+    """
+    The contents of a file in a MemoryFS which are kept somewhere else, and
+    only brought into memory when they are needed.
+    """
+
+    __slots__ = ()
+
+    def load(self):
+        """
+        Retrieve the contents.
+
+        :rtype: L{bytes}
+        """
+
+
+class _Mapped(_Deferred):
+    """
+    The contents of a file in a MemoryFS which are a slice of a mapped image.
+    """
+
+    __slots__ = "view",
+
+    def __init__(self, view):
+        self.view = view
+
+    def __len__(self):
+        return len(self.view)
+
+    def load(self):
+        return bytes(self.view)
+
+
+class _Compressed(_Deferred):
+    """
+    The contents of a file in a MemoryFS which have been compressed.
+    """
+
+    __slots__ = "data", "size"
+
+    def __init__(self, data, size):
+        self.data = data
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def load(self):
+        return zlib.decompress(self.data)
+
+
+class _Spilled(_Deferred):
+    """
+    The contents of a file in a MemoryFS which have been moved out of memory
+    and into a file on disk.
+
+    Forks of a filesystem may share these; the file on disk is removed once
+    nothing refers to it any longer.
+    """
+
+    __slots__ = "path", "size"
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def __del__(self):
+        try:
+            self.path.remove()
+        except OSError:
+            pass
+
+    def load(self):
+        return self.path.getContent()
+
+
+def _residentSize(content):
+    """
+    The number of bytes which some file contents take up in memory.
+    """
+
+    if isinstance(content, _Compressed):
+        return len(content.data)
+    elif isinstance(content, _Deferred):
+        return 0
+    return len(content)
+
+
+class MemoryStats(namedtuple("MemoryStats",
+                              "bytes, spilled, hits, misses, evictions, "
+                              "blobs, deduplicated, files, directories, "
+                              "logical, resident, index, opens, reads, "
+                              "writes, listdirs")):
+    """
+    Statistics about a L{MemoryFS}, as returned by L{MemoryFS.stats}.
+
+    @type bytes: C{int}
+    @ivar bytes: The total size of the contents of all files held in memory,
+        including decompressed copies of compressed files
+
+    @type spilled: C{int}
+    @ivar spilled: The total size of the contents of all files which have
+        been spilled to disk
+
+    @type hits: C{int}
+    @ivar hits: The number of times an existing file was read or opened
+
+    @type misses: C{int}
+    @ivar misses: The number of times a missing file was read or opened for
+        reading
+
+    @type evictions: C{int}
+    @ivar evictions: The number of files evicted or spilled to stay within
+        the budget
+
+    @type blobs: C{int}
+    @ivar blobs: The number of distinct contents stored, when deduplicating
+
+    @type deduplicated: C{int}
+    @ivar deduplicated: The total size of the contents which are stored only
+        once but appear in more than one file
+
+    @type files: C{int}
+    @ivar files: The number of files
+
+    @type directories: C{int}
+    @ivar directories: The number of directories, not counting the root
+
+    @type logical: C{int}
+    @ivar logical: The total size of all files, however they are stored
+
+    @type resident: C{int}
+    @ivar resident: An estimate of the memory taken up by the filesystem,
+        counting the contents held in memory, the objects holding them, the
+        index, and the bookkeeping for deduplication, eviction and the cache
+        of decompressed files
+
+    @type index: C{int}
+    @ivar index: An estimate of the memory taken up by the nodes and
+        directory entries making up the tree
+
+    @type opens: C{int}
+    @ivar opens: The number of files opened
+
+    @type reads: C{int}
+    @ivar reads: The number of whole-file reads, including opening files for
+        reading
+
+    @type writes: C{int}
+    @ivar writes: The number of whole-file writes and writes through handles
+
+    @type listdirs: C{int}
+    @ivar listdirs: The number of directories listed
+    """
+
+
+# Estimates of the memory taken up by each node, each directory entry and
+# each file's contents, on top of the contents themselves. A dict entry is a
+# hash and two pointers, and dicts are kept at most two-thirds full.
+_DIRECTORY_OVERHEAD = sys.getsizeof(_Directory(None)) + sys.getsizeof({})
+_FILE_OVERHEAD = sys.getsizeof(_File(None, None)) + sys.getsizeof(b"")
+_ENTRY_OVERHEAD = 3 * 3 * struct.calcsize("P") // 2
+# Estimates of the bookkeeping kept alongside the tree: each distinct blob
+# when deduplicating, with its digest, its count and its entry in both maps;
+# and each entry of an ordered dict, which also keeps a link and an entry in
+# a second dict.
+_BLOB_OVERHEAD = (2 * _ENTRY_OVERHEAD + sys.getsizeof(b"\0" * 20)
+                  + sys.getsizeof([None, None]) + sys.getsizeof(0))
+_ORDERED_OVERHEAD = 2 * _ENTRY_OVERHEAD + sys.getsizeof([None, None, None])
 
 
 class MemoryFS(object):
     """
     An in-memory filesystem.
+
+    Paths are tuples of segments, resolved through a tree of directory nodes
+    starting from an always-present root directory. Creating a file or
+    directory also creates any missing directories above it.
+
+    The contents of a file are kept as a string until it is opened for
+    writing, at which point they are moved into a bytearray which writable
+    handles modify in place. Once no writable handles remain, the next read
+    turns the contents back into a string, which readers then share.
+
+    Filesystems can be forked in constant time. A fork shares the whole tree
+    with its original; whenever either of them changes a file or directory,
+    it first copies that node and the directories above it, leaving the
+    rest of the tree, and every unchanged file, shared.
+
+    A filesystem may be given a budget, making it usable as a bounded cache.
+    Whenever the contents of its files grow beyond the budget, the least
+    recently used files are evicted until it fits again. Files which are
+    open for writing are never evicted, and a file which is larger than the
+    whole budget is evicted as soon as it has been written.
+
+    If the filesystem is also given a directory to spill to, files are not
+    evicted but spilled: their contents are moved to disk, while the files
+    themselves stay where they are. Listing and measuring spilled files
+    happens entirely in memory, and their contents are brought back into
+    memory the next time they are read or opened.
+
+    Files at least as large as a threshold may be compressed once their
+    contents settle into a string, in which case the budget applies to their
+    compressed size. Sizes are still known without decompressing anything,
+    and the most recently read compressed files are kept decompressed in a
+    small cache of their own, whose size counts towards the budget.
+
+    A filesystem may also deduplicate files, storing each distinct string of
+    contents once no matter how many files hold it. Like a budget, this
+    makes forking take time proportional to the number of distinct
+    contents.
+
+    A filesystem may be shared between threads. Each file is guarded by one
+    of a fixed set of locks, chosen by its path, so that threads working on
+    different files rarely wait on each other; adding and removing entries,
+    and keeping count of what is stored, take separate locks which are only
+    held briefly. Looking up and measuring never lock at all, and listing
+    only locks to be counted. Files are evicted one thread at a time, each
+    under its own lock alone, so that spilling to disk and the eviction hook
+    don't hold up threads working on other files.
+
+    :param int budget: The most bytes of file contents to hold, or C{None}
+                       for no limit.
+    :param callable onEvict: A callable which will be called with the path
+                             and contents of each evicted file.
+    :param FilePath spillTo: An existing directory to spill files to, or
+                             C{None} to evict them instead.
+    :param int compressAbove: The size, in bytes, from which files are
+                              compressed, or C{None} to never compress them.
+    :param int hotBytes: How many bytes of compressed files to keep
+                         decompressed.
+    :param bool dedup: Whether to store identical contents only once.
     """
 
-    def __init__(self):
-        self._store = {}
-        self._dirs = set()
+    def __init__(self, budget=None, onEvict=None, spillTo=None,
+                 compressAbove=None, hotBytes=2 ** 20, dedup=False):
+        # The identity with which this filesystem marks the nodes it owns.
+        self._token = object()
+        self._root = _Directory(self._token)
+        self._readOnly = False
+        # Whether mapped contents are read straight out of their mapping,
+        # rather than being copied into memory the first time they're used.
+        self._keepMapped = False
+        # Paths with open writable handles, and how many of them.
+        self._writers = {}
 
-    def open(self, path):
-        if path in self._dirs:
-            raise Exception("Directories cannot be opened")
-        elif path in self._store:
-            return MemoryFile(self._store, path, self._store[path])
+        # The locks guarding files, one of which guards any given path. The
+        # tree lock guards adding and removing entries, and counting them,
+        # and the accounting lock guards everything else which isn't tied to
+        # a single file.
+        self._stripes = [RLock() for i in range(_STRIPES)]
+        self._tree = RLock()
+        self._accounting = RLock()
+
+        self._budget = budget
+        self._onEvict = onEvict
+        self._spillTo = spillTo
+        # The paths of all files, from least to most recently used, kept
+        # alongside the locks guarding them and mapped to when they were
+        # last used; only tracked when there is a budget to enforce.
+        self._recent = None
+        if budget is not None:
+            self._recent = [OrderedDict() for lock in self._stripes]
+        self._clock = count()
+        # Held while evicting, so that only one thread evicts at a time.
+        self._evicting = Lock()
+
+        self._compressAbove = compressAbove
+        self._hotBytes = hotBytes
+        # Decompressed contents of compressed files, from least to most
+        # recently read, and their total size, which is also counted in
+        # the bytes held.
+        self._hot = OrderedDict()
+        self._hotSize = 0
+
+        # Stored contents, and how many files hold them, by their digests;
+        # only kept when deduplicating. The digests are also kept by the
+        # identities of the stored contents, to find them again.
+        self._blobs = {} if dedup else None
+        self._digests = {}
+        self._deduplicated = 0
+
+        self._fileCount = 0
+        self._directoryCount = 0
+        self._logical = 0
+        self._bytes = 0
+        self._spilled = 0
+        self._evictions = 0
+        # Counts of operations, kept for each lock so that counting doesn't
+        # make threads working on different files wait on each other.
+        self._ops = [dict.fromkeys(("hits", "misses", "opens", "reads",
+                                    "writes", "listdirs"), 0)
+                     for lock in self._stripes]
+
+    def _lookup(self, path):
+        """
+        Find the node at a path, or C{None} if there isn't one.
+        """
+
+        node = self._root
+        for name in path:
+            if not isinstance(node, _Directory):
+                return None
+            node = node.entries.get(name)
+            if node is None:
+                return None
+        return node
+
+    def _stripeFor(self, path):
+        """
+        Get the index of the lock guarding the file at a path.
+        """
+
+        return hash(path) % len(self._stripes)
+
+    def _lockFor(self, path):
+        """
+        Get the lock guarding the file at a path.
+        """
+
+        return self._stripes[self._stripeFor(path)]
+
+    @contextmanager
+    def _quiesced(self):
+        """
+        Hold every lock, so that nothing else can happen to this filesystem.
+        """
+
+        for lock in self._stripes:
+            lock.acquire()
+        try:
+            with self._accounting:
+                with self._tree:
+                    yield
+        finally:
+            for lock in self._stripes:
+                lock.release()
+
+    def _mutableDirectory(self, path):
+        """
+        Find the directory at a path, making it and every directory above it
+        owned by this filesystem, and creating any which are missing.
+        """
+
+        if self._readOnly:
+            raise IOError(errno.EROFS, "Read-only file system", path)
+
+        # Owned directories are never replaced, so if the whole path is
+        # already owned, there's nothing to lock.
+        node = self._root
+        if node.owner is self._token:
+            for name in path:
+                child = node.entries.get(name)
+                if (not isinstance(child, _Directory)
+                    or child.owner is not self._token):
+                    break
+                node = child
+            else:
+                return node
+
+        with self._tree:
+            node = self._root
+            if node.owner is not self._token:
+                node = self._root = node.clone(self._token)
+            for name in path:
+                child = node.entries.get(name)
+                if child is None:
+                    child = node.entries[name] = _Directory(self._token)
+                    self._directoryCount += 1
+                elif not isinstance(child, _Directory):
+                    raise IOError(errno.ENOTDIR, "Not a directory", path)
+                elif child.owner is not self._token:
+                    child = node.entries[name] = child.clone(self._token)
+                node = child
+            return node
+
+    def _mutableFile(self, path):
+        """
+        Find the file at a path, making it owned by this filesystem, or
+        C{None} if there isn't one.
+        """
+
+        parent = self._mutableDirectory(path[:-1])
+        node = parent.entries.get(path[-1])
+        if node is None:
+            return None
+        elif isinstance(node, _Directory):
+            raise IOError(errno.EISDIR, "Is a directory", path)
+        elif node.owner is not self._token:
+            node = parent.entries[path[-1]] = node.clone(self._token)
+        return node
+
+    def _writableContent(self, path):
+        """
+        Get the mutable contents of the file at a path.
+        """
+
+        node = self._mutableFile(path)
+        if node is None:
+            raise IOError(errno.ENOENT, "No such file", path)
+        return self._thaw(node)
+
+    def _release(self, path):
+        """
+        Forget a closed writable handle.
+        """
+
+        with self._accounting:
+            self._forget(path)
+        self._touch(path)
+        self._evict()
+
+    def _forget(self, path):
+        """
+        Stop counting a writable handle.
+
+        Must be called with the accounting lock held.
+        """
+
+        count = self._writers[path] - 1
+        if count:
+            self._writers[path] = count
         else:
-            return MemoryFile(self._store, path)
+            del self._writers[path]
+
+    def _discount(self, content):
+        """
+        Stop accounting for the contents of a file which is going away.
+        """
+
+        with self._accounting:
+            self._logical -= len(content)
+            if isinstance(content, _Spilled):
+                self._spilled -= len(content)
+                return
+
+            digest = self._digests.get(id(content))
+            if digest is not None:
+                blob = self._blobs[digest]
+                if blob[0] is content:
+                    blob[1] -= 1
+                    if blob[1]:
+                        self._deduplicated -= len(content)
+                        return
+                    del self._blobs[digest]
+                    del self._digests[id(content)]
+            self._bytes -= _residentSize(content)
+            if isinstance(content, _Compressed):
+                self._dropHot(content)
+
+    def _store(self, content):
+        """
+        Prepare some string contents to be stored and account for them,
+        compressing them if they are large enough and sharing them with any
+        other file holding the same contents.
+        """
+
+        with self._accounting:
+            self._logical += len(content)
+        if not isinstance(content, bytes):
+            with self._accounting:
+                self._bytes += _residentSize(content)
+            return content
+
+        if self._blobs is not None:
+            digest = sha1(content).digest()
+            with self._accounting:
+                blob = self._blobs.get(digest)
+                if blob is not None:
+                    blob[1] += 1
+                    self._deduplicated += len(content)
+                    return blob[0]
+
+        stored = content
+        if (self._compressAbove is not None
+            and len(content) >= self._compressAbove):
+            stored = _Compressed(zlib.compress(content), len(content))
+
+        with self._accounting:
+            if self._blobs is not None:
+                blob = self._blobs.get(digest)
+                if blob is not None:
+                    # Another thread stored the same contents meanwhile.
+                    blob[1] += 1
+                    self._deduplicated += len(content)
+                    return blob[0]
+                self._blobs[digest] = [stored, 1]
+                self._digests[id(stored)] = digest
+            self._bytes += _residentSize(stored)
+        return stored
+
+    def _thaw(self, node):
+        """
+        Move the contents of an owned file into a bytearray, so that they can
+        be written to in place.
+        """
+
+        content = node.content
+        if not isinstance(content, bytearray):
+            expanded = self._expand(content, remember=False)
+            self._discount(content)
+            node.content = bytearray(expanded)
+            with self._accounting:
+                self._logical += len(node.content)
+                self._bytes += len(node.content)
+        return node.content
+
+    def _expand(self, content, remember=True):
+        """
+        Get the contents of a file as a string, however they are stored.
+
+        Compressed contents are kept decompressed for next time, unless
+        C{remember} is false.
+        """
+
+        if isinstance(content, _Compressed):
+            with self._accounting:
+                expanded = self._hot.get(content)
+                if expanded is not None:
+                    # Mark them as the most recently read.
+                    del self._hot[content]
+                    self._hot[content] = expanded
+                    return expanded
+            expanded = content.load()
+            if remember:
+                self._remember(content, expanded)
+            return expanded
+        elif isinstance(content, _Deferred):
+            return content.load()
+        return bytes(content)
+
+    def _remember(self, compressed, expanded):
+        """
+        Keep the decompressed contents of a compressed file around, making
+        room for them by forgetting the least recently read ones.
+        """
+
+        if len(expanded) > self._hotBytes:
+            return
+        with self._accounting:
+            self._dropHot(compressed)
+            self._hot[compressed] = expanded
+            self._hotSize += len(expanded)
+            self._bytes += len(expanded)
+            while self._hotSize > self._hotBytes:
+                self._dropHot(next(iter(self._hot)))
+
+    def _dropHot(self, compressed):
+        """
+        Forget the decompressed contents of a compressed file, if they are
+        being kept around.
+
+        Must be called with the accounting lock held.
+        """
+
+        expanded = self._hot.pop(compressed, None)
+        if expanded is not None:
+            self._hotSize -= len(expanded)
+            self._bytes -= len(expanded)
+
+    def _load(self, path):
+        """
+        Bring the spilled or mapped contents of a file into memory.
+
+        A read-only filesystem can't be changed, so its deferred contents are
+        loaded but left where they are, as are the mapped contents of a
+        shared filesystem, which are only copied once they are written to.
+
+        :return: The contents of the file.
+        """
+
+        deferred = self._lookup(path).content
+        content = deferred.load()
+        keep = self._keepMapped and isinstance(deferred, _Mapped)
+        if not (self._readOnly or keep):
+            self._replace(path, self._store(content))
+            self._touch(path)
+            self._evict()
+        return content
+
+    def _replace(self, path, stored):
+        """
+        Replace the contents of a file with newly stored ones, unless the file
+        has been removed meanwhile, in which case they're thrown away.
+
+        Must be called with the lock guarding the path held. Removing and
+        moving happen under the accounting lock, so they can't happen while
+        it's held here.
+        """
+
+        with self._accounting:
+            if isinstance(self._lookup(path), _File):
+                node = self._mutableFile(path)
+                self._discount(node.content)
+                node.content = stored
+            else:
+                self._discount(stored)
+
+    def _touch(self, path):
+        """
+        Mark a file as the most recently used.
+        """
+
+        if self._recent is not None:
+            i = self._stripeFor(path)
+            with self._stripes[i]:
+                recent = self._recent[i]
+                recent.pop(path, None)
+                recent[path] = next(self._clock)
+
+    def _untouch(self, path):
+        """
+        Stop tracking the use of a file, unless it has already been made
+        again.
+        """
+
+        if self._recent is not None:
+            i = self._stripeFor(path)
+            with self._stripes[i]:
+                if not isinstance(self._lookup(path), _File):
+                    self._recent[i].pop(path, None)
+
+    def _resized(self, path, buf, delta):
+        """
+        Account for a writable handle changing the size of a file, unless the
+        file has since been replaced and the handle's buffer orphaned.
+        """
+
+        node = self._lookup(path)
+        if isinstance(node, _File) and node.content is buf:
+            with self._accounting:
+                self._logical += delta
+                self._bytes += delta
+            if delta > 0:
+                self._evict()
+
+    def _evict(self):
+        """
+        Evict the least recently used files until the budget is met.
+
+        Must not be called with the accounting or tree locks held, since
+        evicting may write to disk and call the eviction hook. Files whose
+        locks are held by other threads are skipped, as are files being
+        written to.
+        """
+
+        if self._budget is None:
+            return
+
+        evicted = []
+        with self._evicting:
+            # Decompressed contents are only a cache, so they go first.
+            with self._accounting:
+                while self._hot and self._bytes > self._budget:
+                    self._dropHot(next(iter(self._hot)))
+            while self._bytes > self._budget:
+                victim = self._oldest()
+                if victim is None:
+                    # Everything left is busy.
+                    break
+                i, path = victim
+                try:
+                    del self._recent[i][path]
+                    content = self._evictFile(path)
+                finally:
+                    self._stripes[i].release()
+                if content is not None:
+                    evicted.append((path, content))
+
+        for path, content in evicted:
+            self._onEvict(path, self._expand(content, remember=False))
+
+    def _oldest(self):
+        """
+        Find the least recently used file which isn't busy.
+
+        :return: The index of the lock guarding the file, which is held, and
+                 the path of the file; or C{None} if every file is busy.
+        """
+
+        best = None
+        for i, lock in enumerate(self._stripes):
+            if not self._recent[i] or not lock.acquire(False):
+                continue
+            idle = ((used, i, path)
+                    for path, used in self._recent[i].iteritems()
+                    if path not in self._writers)
+            candidate = next(idle, None)
+            if candidate is not None and (best is None or candidate < best):
+                if best is not None:
+                    self._stripes[best[1]].release()
+                best = candidate
+            else:
+                lock.release()
+        if best is None:
+            return None
+        return best[1:]
+
+    def _evictFile(self, path):
+        """
+        Evict a single file, which may already have been removed.
+
+        Must be called with the lock guarding the path held.
+
+        :return: The evicted contents, if the eviction hook should be called
+                 with them.
+        """
+
+        if not isinstance(self._lookup(path), _File):
+            return None
+
+        with self._accounting:
+            self._evictions += 1
+        if self._spillTo is not None:
+            content = self._expand(self._lookup(path).content,
+                                   remember=False)
+            spill = self._spillTo.child(uuid4().hex)
+            spill.setContent(content)
+            with self._accounting:
+                self._logical += len(content)
+                self._spilled += len(content)
+            self._replace(path, _Spilled(spill, len(content)))
+            return None
+
+        with self._tree:
+            node = self._lookup(path)
+            if not isinstance(node, _File):
+                return None
+            parent = self._mutableDirectory(path[:-1])
+            del parent.entries[path[-1]]
+            self._fileCount -= 1
+        self._discount(node.content)
+        if self._onEvict is not None:
+            return node.content
+        return None
+
+    def stats(self):
+        """
+        Retrieve statistics about this filesystem.
+
+        :rtype: L{MemoryStats}
+        """
+
+        ops = dict.fromkeys(self._ops[0], 0)
+        for counts in self._ops:
+            for op, count in counts.items():
+                ops[op] += count
+
+        with self._accounting:
+            blobs = len(self._blobs) if self._blobs is not None else 0
+            index = (self._directoryCount * _DIRECTORY_OVERHEAD
+                     + (self._fileCount + self._directoryCount)
+                     * _ENTRY_OVERHEAD)
+            bookkeeping = (blobs * _BLOB_OVERHEAD + len(self._hot)
+                           * (_ORDERED_OVERHEAD + sys.getsizeof(b"")))
+            if self._recent is not None:
+                bookkeeping += (sum(len(recent) for recent in self._recent)
+                                * (_ORDERED_OVERHEAD + sys.getsizeof(0)))
+            resident = (self._bytes + self._fileCount * _FILE_OVERHEAD
+                        + index + bookkeeping)
+            return MemoryStats(self._bytes, self._spilled, ops["hits"],
+                               ops["misses"], self._evictions, blobs,
+                               self._deduplicated, self._fileCount,
+                               self._directoryCount, self._logical,
+                               resident, index, ops["opens"], ops["reads"],
+                               ops["writes"], ops["listdirs"])
+
+    def fork(self):
+        """
+        Create an independent copy of this filesystem, in constant time.
+
+        If this filesystem has a budget, the fork gets the same budget and
+        its own copy of the order in which files were used, which takes time
+        proportional to the number of files.
+
+        :return: A new, writable L{MemoryFS}.
+        """
+
+        fork = MemoryFS(self._budget, self._onEvict, self._spillTo,
+                        self._compressAbove, self._hotBytes)
+        with self._quiesced():
+            fork._root = self._root
+            fork._fileCount = self._fileCount
+            fork._directoryCount = self._directoryCount
+            fork._logical = self._logical
+            fork._bytes = self._bytes
+            fork._spilled = self._spilled
+            fork._hot = OrderedDict(self._hot)
+            fork._hotSize = self._hotSize
+            if self._blobs is not None:
+                fork._blobs = dict((digest, list(blob))
+                                   for digest, blob in self._blobs.items())
+                fork._digests = dict(self._digests)
+                fork._deduplicated = self._deduplicated
+            if self._recent is not None:
+                fork._recent = [OrderedDict(recent)
+                                for recent in self._recent]
+                fork._clock = count(next(self._clock))
+            # Neither filesystem may now change the shared nodes in place.
+            self._token = object()
+        return fork
+
+    def snapshot(self):
+        """
+        Capture the current state of this filesystem, in constant time.
+
+        :return: A read-only L{MemoryFS}, which may itself be forked.
+        """
+
+        snapshot = self.fork()
+        snapshot._readOnly = True
+        return snapshot
+
+    def _image(self):
+        """
+        Lay this filesystem out as an image.
+
+        :return: A list of strings which together make up the image.
+        """
+
+        entries = []
+        blobs = []
+        offset = 0
+        # Saving a snapshot leaves this filesystem free to carry on.
+        pending = [((), self.snapshot()._root)]
+        while pending:
+            path, node = pending.pop()
+            children = sorted(node.entries.items(), reverse=True,
+                              key=lambda item: encodeName(item[0]))
+            for name, child in children:
+                childPath = path + (name,)
+                if isinstance(child, _Directory):
+                    entries.append((_IMAGE_DIR, childPath, 0, 0))
+                    pending.append((childPath, child))
+                else:
+                    content = self._expand(child.content, remember=False)
+                    entries.append((_IMAGE_FILE, childPath, offset,
+                                    len(content)))
+                    blobs.append(content)
+                    offset += len(content)
+
+        index = []
+        for kind, path, offset, size in entries:
+            if isinstance(path[-1], unicode):
+                kind |= _IMAGE_UNICODE
+            name = b"\0".join(encodeName(segment) for segment in path)
+            index.append(_IMAGE_ENTRY.pack(kind, len(name), offset, size))
+            index.append(name)
+        index = b"".join(index)
+
+        header = _IMAGE_HEADER.pack(_IMAGE_MAGIC, len(entries),
+                                    _IMAGE_HEADER.size + len(index))
+        return [header, index] + blobs
+
+    def save(self, fp):
+        """
+        Save this filesystem as an image, which can be loaded again with
+        L{MemoryFS.load}.
+
+        :param FilePath fp: The file to write the image to.
+        """
+
+        with fp.open("wb") as handle:
+            for part in self._image():
+                handle.write(part)
+
+    def share(self, **kwargs):
+        """
+        Copy this filesystem into memory which will be shared with any
+        processes forked from this one.
+
+        The copy is laid out as an image, just like L{MemoryFS.save} would
+        write, in an anonymous shared mapping, and then loaded from there.
+        Forked processes inherit the loaded filesystem and read its files
+        straight out of the mapping, so however many of them there are, the
+        contents are only held once.
+
+        The mapping never changes once it is made. Changes to this
+        filesystem, or to the shared one in any process, are not seen by the
+        others; share again to publish them.
+
+        :param kwargs: Passed along to L{MemoryFS}.
+
+        :return: A new, writable L{MemoryFS}.
+        """
+
+        parts = self._image()
+        image = mmap.mmap(-1, sum(len(part) for part in parts))
+        for part in parts:
+            image.write(part)
+        fs = self._fromImage(image, **kwargs)
+        fs._keepMapped = True
+        return fs
+
+    @classmethod
+    def load(cls, fp, **kwargs):
+        """
+        Load a filesystem from an image written by L{MemoryFS.save}.
+
+        The image is mapped rather than read, so only its index is read up
+        front. The contents of each file stay in the mapping, shared with
+        any other process which loaded the same image, until the file is
+        read or written.
+
+        :param FilePath fp: The image to load.
+        :param kwargs: Passed along to L{MemoryFS}.
+
+        :return: A new, writable L{MemoryFS}.
+        """
+
+        with fp.open("rb") as handle:
+            image = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic = _IMAGE_HEADER.unpack_from(image)[0]
+        if magic != _IMAGE_MAGIC:
+            raise ValueError("Not a MemoryFS image: %r" % (fp,))
+        return cls._fromImage(image, **kwargs)
+
+    @classmethod
+    def _fromImage(cls, image, **kwargs):
+        """
+        Make a filesystem whose files refer to the contents in an image.
+        """
+
+        magic, count, start = _IMAGE_HEADER.unpack_from(image)
+        fs = cls(**kwargs)
+        # The paths of the directories seen so far, by their encoded paths.
+        directories = {(): ()}
+        position = _IMAGE_HEADER.size
+        for i in range(count):
+            kind, length, offset, size = _IMAGE_ENTRY.unpack_from(image,
+                                                                  position)
+            position += _IMAGE_ENTRY.size
+            encoded = tuple(image[position:position + length].split(b"\0"))
+            position += length
+            name = encoded[-1]
+            if kind & _IMAGE_UNICODE:
+                name = name.decode("utf-8")
+            path = directories[encoded[:-1]] + (name,)
+            if kind & ~_IMAGE_UNICODE == _IMAGE_DIR:
+                directories[encoded] = path
+                fs._mutableDirectory(path)
+            else:
+                view = buffer(image, start + offset, size)
+                node = _File(fs._token, _Mapped(view))
+                fs._mutableDirectory(path[:-1]).entries[path[-1]] = node
+                fs._fileCount += 1
+                fs._logical += size
+        return fs
+
+    def _count(self, hit, path):
+        """
+        Count a read of an existing or missing file.
+        """
+
+        self._tally("hits" if hit else "misses", path)
+
+    def _tally(self, op, path):
+        """
+        Count an operation on a path, under the lock guarding the path.
+        """
+
+        i = self._stripeFor(path)
+        with self._stripes[i]:
+            self._ops[i][op] += 1
+
+    def importTree(self, filePath, workers=1, mapAbove=None):
+        """
+        Copy a directory on disk, and everything beneath it, into the root of
+        this filesystem.
+
+        Directories are listed a level at a time, with a single C{lstat()}
+        of each entry, and files are then read on a pool of threads.
+        Symlinks to files are followed, but symlinks to directories and
+        anything which isn't a regular file are skipped.
+
+        Files at least as large as C{mapAbove} are mapped rather than read,
+        like files loaded from an image, and are only brought into memory
+        when they are used. Changes made on disk to a mapped file before
+        then are visible through this filesystem.
+
+        :param FilePath filePath: The directory to copy.
+        :param int workers: The number of threads to read files with.
+        :param int mapAbove: The size, in bytes, from which files are
+                             mapped, or C{None} to always read them.
+        """
+
+        files = []
+        frontier = [(filePath.path, ())]
+        while frontier:
+            subdirs = []
+            for osPath, path in frontier:
+                self._mutableDirectory(path)
+                for name in os.listdir(osPath):
+                    child = os.path.join(osPath, name)
+                    st = os.lstat(child)
+                    if S_ISDIR(st.st_mode):
+                        subdirs.append((child, path + (name,)))
+                        continue
+                    elif S_ISLNK(st.st_mode):
+                        try:
+                            st = os.stat(child)
+                        except OSError:
+                            # Dangling.
+                            continue
+                    if S_ISREG(st.st_mode):
+                        files.append((child, path + (name,), st.st_size))
+            frontier = subdirs
+
+        def read(item):
+            osPath, path, size = item
+            with open(osPath, "rb") as handle:
+                if mapAbove is not None and size >= max(mapAbove, 1):
+                    mapping = mmap.mmap(handle.fileno(), 0,
+                                        access=mmap.ACCESS_READ)
+                    self.setContent(path, _Mapped(buffer(mapping)))
+                else:
+                    self.setContent(path, handle.read())
+
+        parallelMap(read, files, workers)
+
+    def exportTree(self, filePath, workers=1):
+        """
+        Copy this whole filesystem into a directory on disk, which is created
+        if it doesn't exist.
+
+        The filesystem is copied as it was when this method was called, and
+        files are written on a pool of threads. Existing files in the way
+        are overwritten.
+
+        Nothing is copied from a filesystem with a path which would put it
+        outside of C{filePath}.
+
+        :param FilePath filePath: The directory to copy into.
+        :param int workers: The number of threads to write files with.
+
+        :raises InsecurePath: If a path isn't a safe relative path.
+        """
+
+        snapshot = self.snapshot()
+        directories = []
+        files = []
+        pending = [(filePath, snapshot._root)]
+        while pending:
+            target, node = pending.pop()
+            directories.append(target)
+            for name, child in node.entries.items():
+                if isinstance(child, _Directory):
+                    pending.append((target.child(name), child))
+                else:
+                    files.append((target.child(name), child))
+
+        for target in directories:
+            ensureDirectory(target.path)
+
+        def write(item):
+            target, node = item
+            with open(target.path, "wb") as handle:
+                handle.write(snapshot._expand(node.content,
+                                              remember=False))
+
+        parallelMap(write, files, workers)
+
+    def open(self, path, mode="r"):
+        self._tally("opens", path)
+        node = self._lookup(path)
+        if isinstance(node, _Directory):
+            raise Exception("Directories cannot be opened")
+        elif not modeIsWriting(mode):
+            if node is None:
+                self._count(False, path)
+                raise IOError(errno.ENOENT, "No such file", path)
+            return MemoryReadFile(self.getContent(path))
+
+        with self._lockFor(path):
+            # The handle is counted before its file is found or made, so that
+            # the file can't be removed or moved away in between.
+            with self._accounting:
+                self._writers[path] = self._writers.get(path, 0) + 1
+            try:
+                node = self._mutableFile(path)
+                if node is not None:
+                    self._count(True, path)
+                    if "w" in mode:
+                        self._discount(node.content)
+                        if isinstance(node.content, bytearray):
+                            # Other handles may share this buffer; truncate
+                            # it for them too.
+                            del node.content[:]
+                        else:
+                            node.content = bytearray()
+                    else:
+                        self._thaw(node)
+                elif "w" in mode or "a" in mode:
+                    with self._tree:
+                        parent = self._mutableDirectory(path[:-1])
+                        node = parent.entries.get(path[-1])
+                        if node is None:
+                            node = _File(self._token, bytearray())
+                            parent.entries[path[-1]] = node
+                            self._fileCount += 1
+                    if isinstance(node, _Directory):
+                        raise Exception("Directories cannot be opened")
+                else:
+                    raise IOError(errno.ENOENT, "No such file", path)
+            except:
+                with self._accounting:
+                    self._forget(path)
+                raise
+
+            self._touch(path)
+            return MemoryFile(self, path, node.content, mode)
+
+    def createDirectory(self, path):
+        with self._lockFor(path):
+            node = self._lookup(path)
+            if isinstance(node, _File):
+                raise OSError(errno.EEXIST, "File exists", path)
+            self._mutableDirectory(path)
+
+    def getContent(self, path):
+        self._tally("reads", path)
+        with self._lockFor(path):
+            node = self._lookup(path)
+            if not isinstance(node, _File):
+                self._count(False, path)
+                raise KeyError(path)
+            self._count(True, path)
+            content = node.content
+            if isinstance(content, (_Mapped, _Spilled)):
+                return self._load(path)
+            self._touch(path)
+            if isinstance(content, _Compressed):
+                return self._expand(content)
+            elif isinstance(content, bytearray):
+                if path in self._writers:
+                    return bytes(content)
+                content = bytes(content)
+                if node.owner is self._token:
+                    self._replace(path, self._store(content))
+                else:
+                    # Freezing doesn't change the contents, so this is safe
+                    # even if the node is shared, but storing them would
+                    # change how the sharing filesystems account for them.
+                    node.content = content
+            return content
+
+    def setContent(self, path, content):
+        self._tally("writes", path)
+        with self._lockFor(path):
+            stored = self._store(content)
+            try:
+                # The directory is found under the tree lock, so that it
+                # can't be removed before the file is put in it.
+                with self._tree:
+                    parent = self._mutableDirectory(path[:-1])
+                    old = parent.entries.get(path[-1])
+                    if not isinstance(old, _Directory):
+                        parent.entries[path[-1]] = _File(self._token, stored)
+                    if old is None:
+                        self._fileCount += 1
+            except IOError:
+                self._discount(stored)
+                raise
+            if isinstance(old, _Directory):
+                self._discount(stored)
+                raise IOError(errno.EISDIR, "Is a directory", path)
+            elif old is not None:
+                self._discount(old.content)
+            self._touch(path)
+            self._evict()
+
+    def _walk(self, node, path):
+        """
+        Find every file and directory at or beneath a node.
+
+        :return: An iterator of the paths and nodes.
+        """
+
+        pending = [(path, node)]
+        while pending:
+            path, node = pending.pop()
+            yield path, node
+            if isinstance(node, _Directory):
+                for name, child in node.entries.items():
+                    pending.append((path + (name,), child))
+
+    def _checkIdle(self, path):
+        """
+        Make sure that no file at or beneath a path is open for writing.
+        """
+
+        for writing in self._writers:
+            if writing[:len(path)] == path:
+                raise OSError(errno.EBUSY, "Device or resource busy", path)
+
+    def remove(self, path):
+        """
+        Remove the file or directory at a path, along with everything beneath
+        it.
+
+        Files which are open for writing can't be removed, nor can the
+        directories holding them.
+        """
+
+        if not path:
+            raise OSError(errno.EBUSY, "Device or resource busy", path)
+
+        removed = []
+        with self._accounting:
+            self._checkIdle(path)
+            with self._tree:
+                if self._lookup(path) is None:
+                    raise OSError(errno.ENOENT, "No such file or directory",
+                                  path)
+                parent = self._mutableDirectory(path[:-1])
+                node = parent.entries.pop(path[-1])
+            directories = 0
+            for childPath, child in self._walk(node, path):
+                if isinstance(child, _Directory):
+                    directories += 1
+                    continue
+                removed.append(childPath)
+                self._discount(child.content)
+            with self._tree:
+                self._fileCount -= len(removed)
+                self._directoryCount -= directories
+
+        for childPath in removed:
+            self._untouch(childPath)
+
+    def move(self, source, destination):
+        """
+        Move the file or directory at one path to another.
+
+        Moving only relinks the node at the source path, so moving a
+        directory doesn't depend on how much is beneath it, unless there is a
+        budget, in which case every file beneath it is marked as used.
+
+        As with C{rename()}, a file replaces any file at the destination,
+        and a directory replaces any empty directory there. Files which are
+        open for writing can't be moved, nor can the directories holding
+        them.
+        """
+
+        if not source or not destination:
+            raise OSError(errno.EBUSY, "Device or resource busy")
+        elif destination[:len(source)] == source:
+            if destination == source:
+                return
+            raise OSError(errno.EINVAL, "Invalid argument", destination)
+
+        with self._accounting:
+            self._checkIdle(source)
+            self._checkIdle(destination)
+            with self._tree:
+                node = self._lookup(source)
+                if node is None:
+                    raise OSError(errno.ENOENT, "No such file or directory",
+                                  source)
+                target = self._lookup(destination)
+                if isinstance(target, _Directory):
+                    if not isinstance(node, _Directory):
+                        raise OSError(errno.EISDIR, "Is a directory",
+                                      destination)
+                    elif target.entries:
+                        raise OSError(errno.ENOTEMPTY, "Directory not empty",
+                                      destination)
+                elif target is not None and isinstance(node, _Directory):
+                    raise OSError(errno.ENOTDIR, "Not a directory",
+                                  destination)
+
+                sourceParent = self._mutableDirectory(source[:-1])
+                destinationParent = self._mutableDirectory(destination[:-1])
+                del sourceParent.entries[source[-1]]
+                destinationParent.entries[destination[-1]] = node
+                if isinstance(target, _File):
+                    self._fileCount -= 1
+                elif target is not None:
+                    self._directoryCount -= 1
+
+            if isinstance(target, _File):
+                self._discount(target.content)
+
+        if self._recent is not None:
+            for path, child in self._walk(node, source):
+                if isinstance(child, _File):
+                    self._untouch(path)
+                    self._touch(destination + path[len(source):])
+
+    def listdir(self, path):
+        self._tally("listdirs", path)
+        return list(self._lookup(path).entries)
+
+    def isdir(self, path):
+        return isinstance(self._lookup(path), _Directory)
+
+    def isfile(self, path):
+        return isinstance(self._lookup(path), _File)
+
+    def getsize(self, path):
+        node = self._lookup(path)
+        if not isinstance(node, _File):
+            raise Exception("Non-file has no size")
+        return len(node.content)
 
 
 def format_memory_path(path, sep):
@@ -100,17 +1609,10 @@ class MemoryPath(object):
         Pretend that we are a directory and get a listing of child names.
         """
 
-        if self._path not in self._fs._dirs:
+        if not self._fs.isdir(self._path):
             raise UnlistableError()
 
-        i = chain(self._fs._dirs, self._fs._store.iterkeys())
-
-        # Linear-time search. Could be better.
-        p = self._path
-        l = len(p) + 1
-        ks = [t[-1] for t in i if t[:-1] == p and len(t) == l]
-
-        return ks
+        return self._fs.listdir(self._path)
 
     # IFilePath generic methods
 
@@ -137,16 +1639,24 @@ class MemoryPath(object):
     # IFilePath writing and reading
 
     def open(self, mode="r"):
-        return self._fs.open(self._path)
+        return self._fs.open(self._path, mode)
 
     def createDirectory(self):
-        self._fs._dirs.add(self._path)
+        self._fs.createDirectory(self._path)
 
     def getContent(self):
-        return self._fs._store[self._path]
+        return self._fs.getContent(self._path)
 
     def setContent(self, content, ext=b".new"):
-        self._fs._store[self._path] = content
+        self._fs.setContent(self._path, content)
+
+    def remove(self):
+        self._fs.remove(self._path)
+
+    def moveTo(self, destination, followLinks=True):
+        if getattr(destination, "_fs", None) is not self._fs:
+            raise OSError(errno.EXDEV, "Cross-device link", destination.path)
+        self._fs.move(self._path, destination._path)
 
     # IFilePath stat and other queries
 
@@ -154,10 +1664,10 @@ class MemoryPath(object):
         pass
 
     def isdir(self):
-        return self._path in self._fs._dirs
+        return self._fs.isdir(self._path)
 
     def isfile(self):
-        return self._path in self._fs._store
+        return self._fs.isfile(self._path)
 
     def islink(self):
         return False
@@ -169,10 +1679,7 @@ class MemoryPath(object):
         return self._path[-1] if self._path else ""
 
     def getsize(self):
-        if self._path in self._fs._store:
-            return len(self._fs._store[self._path])
-        else:
-            raise Exception("Non-file has no size")
+        return self._fs.getsize(self._path)
 
     def getModificationTime(self):
         return 0.0
@@ -0,0 +1,63 @@
+# Copyright (C) 2014 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+from io import BytesIO
+from random import Random
+from unittest import TestCase
+
+from bp.delta import blockSignatures, computeDelta, patch
+
+
+class TestDelta(TestCase):
+
+    blockSize = 64
+
+    def setUp(self):
+        r = Random(42)
+        self.basis = b"".join(chr(r.randrange(256)) for i in range(4096))
+
+    def roundTrip(self, new):
+        signatures = blockSignatures(BytesIO(self.basis), self.blockSize)
+        instructions = list(computeDelta(BytesIO(new), signatures,
+                                         self.blockSize))
+        target = BytesIO()
+        patch(BytesIO(self.basis), instructions, target, self.blockSize)
+        self.assertEqual(target.getvalue(), new)
+        return instructions
+
+    def literalSize(self, instructions):
+        return sum(len(i) for i in instructions if isinstance(i, bytes))
+
+    def test_unchanged(self):
+        instructions = self.roundTrip(self.basis)
+        self.assertEqual(instructions, range(4096 // self.blockSize))
+
+    def test_inPlaceChange(self):
+        new = self.basis[:1000] + b"X" + self.basis[1001:]
+        instructions = self.roundTrip(new)
+        self.assertTrue(self.literalSize(instructions) <= 2 * self.blockSize)
+
+    def test_shiftedByInsertion(self):
+        new = self.basis[:100] + b"inserted" + self.basis[100:]
+        instructions = self.roundTrip(new)
+        self.assertTrue(self.literalSize(instructions) <= 2 * self.blockSize)
+
+    def test_truncatedAndExtended(self):
+        self.roundTrip(self.basis[:2000] + b"a short tail")
+
+    def test_empty(self):
+        self.assertEqual(self.roundTrip(b""), [])
+
+    def test_unrelated(self):
+        instructions = self.roundTrip(b"nothing in common" * 10)
+        self.assertEqual(self.literalSize(instructions), 170)
@@ -11,6 +11,15 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
+import errno
+import os
+import sys
+from tempfile import mkdtemp
+from threading import Thread
+
+from twisted.trial.unittest import SynchronousTestCase as TestCase
+
+from bp.filepath import FilePath, InsecurePath
 from bp.memory import MemoryFS, MemoryPath, format_memory_path
 from bp.tests.test_paths import AbstractFilePathTestCase
 
@@ -24,20 +33,1227 @@ class MemoryPathTestCase(AbstractFilePathTestCase):
 
     def subdir(self, *dirname):
         for head in heads(dirname):
-            self.fs._dirs.add(head)
-        self.fs._dirs.add(dirname)
+            self.fs.createDirectory(head)
+            self.made.add(head)
+        self.fs.createDirectory(dirname)
+        self.made.add(dirname)
 
     def subfile(self, *dirname):
         for head in heads(dirname):
-            self.fs._dirs.add(head)
-        return self.fs.open(dirname)
+            self.fs.createDirectory(head)
+            self.made.add(head)
+        self.made.add(dirname)
+        return self.fs.open(dirname, "w")
 
     def setUp(self):
         self.fs = MemoryFS()
+        self.made = set()
 
         AbstractFilePathTestCase.setUp(self)
 
         self.path = MemoryPath(self.fs)
         self.root = self.path
-        self.all = self.fs._dirs | set(self.fs._store.keys())
-        self.all = set(format_memory_path(p, "/") for p in self.all)
+        self.all = set(format_memory_path(p, "/") for p in self.made)
+
+    def test_listdirOnlyChildren(self):
+        """
+        L{MemoryPath.listdir} lists direct children, whether they were created
+        as directories, with C{setContent}, or by closing an opened file.
+        """
+        sub = self.path.child("sub4")
+        sub.createDirectory()
+        sub.child("set").setContent("content")
+        sub.child("deeper").createDirectory()
+        sub.child("deeper").child("hidden").setContent("content")
+        sub.child("opened").open("w").close()
+        self.assertEqual(sorted(sub.listdir()), ["deeper", "opened", "set"])
+
+    def test_listdirEmpty(self):
+        """
+        An empty directory lists no children.
+        """
+        sub = self.path.child("sub4")
+        sub.createDirectory()
+        self.assertEqual(sub.listdir(), [])
+
+    def test_openReadShares(self):
+        """
+        Opening a file for reading shares its contents instead of copying
+        them, and closing it does not write anything back.
+        """
+        f = self.path.child("file1")
+        content = f.getContent()
+        with f.open() as handle:
+            self.assertEqual(handle.read(), content)
+            self.assertIdentical(handle.getvalue(), content)
+        self.assertIdentical(f.getContent(), content)
+
+    def test_openReadOnly(self):
+        """
+        Files opened for reading cannot be written to.
+        """
+        with self.path.child("file1").open() as handle:
+            self.assertRaises(IOError, handle.write, "content")
+
+    def test_openReadMissing(self):
+        """
+        Opening a missing file for reading fails, and does not create it.
+        """
+        missing = self.path.child("missing")
+        self.assertRaises(IOError, missing.open)
+        self.assertFalse(missing.exists())
+
+    def test_openWrite(self):
+        """
+        Files opened for writing save their contents when closed.
+        """
+        with self.path.child("file1").open("w") as handle:
+            handle.write("new")
+        self.assertEqual(self.path.child("file1").getContent(), "new")
+
+    def test_openAppend(self):
+        """
+        Files opened for appending are written at their ends, regardless of
+        seeking.
+        """
+        f = self.path.child("file1")
+        with f.open("a") as handle:
+            handle.write(" and more")
+            handle.seek(0)
+            handle.write(" and still more")
+        self.assertEqual(f.getContent(), self.f1content + " and more"
+                         " and still more")
+
+    def test_openAppendCreates(self):
+        """
+        Opening a missing file for appending creates it.
+        """
+        f = self.path.child("new")
+        with f.open("a") as handle:
+            handle.write("content")
+        self.assertEqual(f.getContent(), "content")
+        self.assertIn("new", self.path.listdir())
+
+    def test_openUpdate(self):
+        """
+        Files opened with C{"r+"} can be read and overwritten in place.
+        """
+        f = self.path.child("file1")
+        with f.open("r+") as handle:
+            self.assertEqual(handle.read(4), self.f1content[:4])
+            handle.write("X")
+            handle.seek(0)
+            self.assertEqual(handle.read(), "fileX1")
+
+    def test_openUpdateMissing(self):
+        """
+        Opening a missing file with C{"r+"} fails.
+        """
+        self.assertRaises(IOError, self.path.child("missing").open, "r+")
+
+    def test_writesVisibleWhileOpen(self):
+        """
+        The contents of a file opened for writing can be read before it is
+        closed.
+        """
+        f = self.path.child("file1")
+        with f.open("a") as handle:
+            handle.write("!")
+            self.assertEqual(f.getContent(), self.f1content + "!")
+            handle.write("!")
+        self.assertEqual(f.getContent(), self.f1content + "!!")
+
+    def test_truncateAndSeekPastEnd(self):
+        """
+        Writing past the end of a file fills the gap with zero bytes, and
+        truncating can shrink or grow it.
+        """
+        f = self.path.child("file1")
+        with f.open("r+") as handle:
+            handle.seek(8)
+            handle.write("!")
+            self.assertEqual(f.getContent(), self.f1content + "\0\0!")
+            handle.truncate(4)
+            self.assertEqual(f.getContent(), "file")
+            handle.truncate(5)
+            self.assertEqual(f.getContent(), "file\0")
+
+    def test_readLines(self):
+        """
+        Writable handles can be read line by line.
+        """
+        f = self.path.child("lines")
+        f.setContent("one\ntwo\nthree")
+        with f.open("r+") as handle:
+            self.assertEqual(list(handle), ["one\n", "two\n", "three"])
+
+    def test_writeOnlyUnreadable(self):
+        """
+        Files opened with C{"w"} or C{"a"} cannot be read.
+        """
+        with self.path.child("file1").open("w") as handle:
+            self.assertRaises(IOError, handle.read)
+
+    def test_implicitParents(self):
+        """
+        Creating a file or directory creates the directories above it.
+        """
+        self.path.child("a").child("b").setContent("content")
+        self.path.child("c").child("d").createDirectory()
+        self.assertTrue(self.path.child("a").isdir())
+        self.assertTrue(self.path.child("c").isdir())
+
+    def test_fileParent(self):
+        """
+        Files cannot be created beneath other files.
+        """
+        child = self.path.child("file1").child("child")
+        self.assertRaises(IOError, child.setContent, "content")
+
+    def test_fork(self):
+        """
+        Changes to a fork and to its original are independent of each other.
+        """
+        fork = MemoryPath(self.fs.fork())
+        fork.child("file1").setContent("forked")
+        fork.child("sub1").child("new").createDirectory()
+        self.path.child("sub3").child("file3.ext1").setContent("original")
+
+        self.assertEqual(self.path.child("file1").getContent(),
+                         self.f1content)
+        self.assertFalse(self.path.child("sub1").child("new").exists())
+        self.assertEqual(fork.child("file1").getContent(), "forked")
+        self.assertEqual(fork.child("sub3").child("file3.ext1").getContent(),
+                         "")
+
+    def test_forkShares(self):
+        """
+        A fork shares unchanged files with its original.
+        """
+        content = self.path.child("sub1").child("file2").getContent()
+        fork = MemoryPath(self.fs.fork())
+        fork.child("file1").setContent("forked")
+        self.assertIdentical(fork.child("sub1").child("file2").getContent(),
+                             content)
+
+    def test_forkWithOpenFile(self):
+        """
+        Writes through a handle opened before a fork are not seen by the
+        fork.
+        """
+        f = self.path.child("file1")
+        with f.open("a") as handle:
+            handle.write(" before")
+            fork = MemoryPath(self.fs.fork())
+            handle.write(" after")
+        self.assertEqual(f.getContent(), self.f1content + " before after")
+        self.assertEqual(fork.child("file1").getContent(),
+                         self.f1content + " before")
+
+    def test_forkAppendInFork(self):
+        """
+        Appending to a file in a fork leaves the original's copy alone.
+        """
+        fork = MemoryPath(self.fs.fork())
+        with fork.child("file1").open("a") as handle:
+            handle.write(" forked")
+        self.assertEqual(self.path.child("file1").getContent(),
+                         self.f1content)
+        self.assertEqual(fork.child("file1").getContent(),
+                         self.f1content + " forked")
+
+    def test_snapshot(self):
+        """
+        Snapshots are read-only, but can be forked.
+        """
+        snapshot = self.fs.snapshot()
+        self.path.child("file1").setContent("changed")
+
+        frozen = MemoryPath(snapshot)
+        self.assertEqual(frozen.child("file1").getContent(), self.f1content)
+        self.assertRaises(IOError, frozen.child("file1").setContent, "x")
+        self.assertRaises(IOError, frozen.child("file1").open, "w")
+        self.assertRaises(IOError, frozen.child("new").createDirectory)
+
+        fork = MemoryPath(snapshot.fork())
+        fork.child("file1").setContent("forked")
+        self.assertEqual(frozen.child("file1").getContent(), self.f1content)
+
+    def test_remove(self):
+        """
+        Removing a directory removes everything beneath it.
+        """
+        size = self.fs.stats().bytes
+        self.path.child("sub1").remove()
+        self.path.child("file1").remove()
+        self.assertFalse(self.path.child("sub1").exists())
+        self.assertFalse(self.path.child("sub1").child("file2").exists())
+        self.assertFalse(self.path.child("file1").exists())
+        self.assertEqual(self.fs.stats().bytes,
+                         size - len(self.f1content) - len(self.f2content))
+
+    def test_removeMissing(self):
+        """
+        Removing a missing path raises L{OSError}.
+        """
+        self.assertRaises(OSError, self.path.child("missing").remove)
+
+    def test_moveTo(self):
+        """
+        Moving a directory takes everything beneath it along.
+        """
+        destination = self.path.child("sub2").child("moved")
+        self.path.child("sub1").moveTo(destination)
+        self.assertFalse(self.path.child("sub1").exists())
+        self.assertEqual(destination.child("file2").getContent(),
+                         self.f2content)
+
+    def test_moveToReplaces(self):
+        """
+        Moving a file over another replaces it, and moving a directory over
+        an empty one replaces it, but nothing else may be moved over.
+        """
+        self.path.child("file1").moveTo(self.path.child("sub3")
+                                        .child("file3.ext1"))
+        self.assertEqual(self.path.child("sub3").child("file3.ext1")
+                         .getContent(), self.f1content)
+        self.path.child("sub1").moveTo(self.path.child("sub2"))
+        self.assertTrue(self.path.child("sub2").child("file2").exists())
+        self.assertRaises(OSError, self.path.child("sub2").moveTo,
+                          self.path.child("sub3"))
+        self.assertRaises(OSError, self.path.child("sub2").moveTo,
+                          self.path.child("sub3").child("file3.ext2"))
+        self.assertRaises(OSError, self.path.child("sub2").moveTo,
+                          self.path.child("sub2").child("inside"))
+
+    def test_moveToFork(self):
+        """
+        Moving a directory in a fork leaves the original alone.
+        """
+        fork = MemoryPath(self.fs.fork())
+        fork.child("sub1").moveTo(fork.child("moved"))
+        self.assertTrue(self.path.child("sub1").child("file2").exists())
+        self.assertTrue(fork.child("moved").child("file2").exists())
+
+    def test_moveToOpen(self):
+        """
+        Files open for writing, and the directories holding them, can't be
+        moved or removed.
+        """
+        with self.path.child("sub1").child("file2").open("a"):
+            self.assertRaises(OSError, self.path.child("sub1").moveTo,
+                              self.path.child("moved"))
+            self.assertRaises(OSError, self.path.child("sub1").remove)
+        self.path.child("sub1").remove()
+
+    def test_moveToOtherFilesystem(self):
+        """
+        Paths can't be moved into another filesystem, in memory or not.
+        """
+        other = MemoryPath(MemoryFS()).child("moved")
+        e = self.assertRaises(OSError, self.path.child("sub1").moveTo, other)
+        self.assertEqual(e.errno, errno.EXDEV)
+        e = self.assertRaises(OSError, self.path.child("sub1").moveTo,
+                              FilePath(self.mktemp()))
+        self.assertEqual(e.errno, errno.EXDEV)
+
+
+class MemoryFSBudgetTestCase(TestCase):
+    """
+    Tests for L{MemoryFS} used as a bounded cache.
+    """
+
+    def setUp(self):
+        self.evicted = []
+        self.fs = MemoryFS(budget=10,
+                           onEvict=lambda *a: self.evicted.append(a))
+        self.root = MemoryPath(self.fs)
+
+    def test_accounting(self):
+        """
+        L{MemoryFS.stats} keeps track of the size of all file contents.
+        """
+        fs = MemoryFS()
+        root = MemoryPath(fs)
+        root.child("a").setContent("12345")
+        root.child("b").setContent("123")
+        self.assertEqual(fs.stats().bytes, 8)
+        root.child("a").setContent("1")
+        with root.child("b").open("a") as handle:
+            handle.write("4567")
+        self.assertEqual(fs.stats().bytes, 8)
+        root.child("b").open("w").close()
+        self.assertEqual(fs.stats().bytes, 1)
+
+    def test_evictLeastRecentlyUsed(self):
+        """
+        When the budget is exceeded, the least recently used files are
+        evicted, and the eviction hook learns about them.
+        """
+        self.root.child("a").setContent("1234")
+        self.root.child("b").setContent("1234")
+        self.root.child("a").getContent()
+        self.root.child("c").setContent("1234")
+
+        self.assertFalse(self.root.child("b").exists())
+        self.assertTrue(self.root.child("a").exists())
+        self.assertTrue(self.root.child("c").exists())
+        self.assertEqual(self.evicted, [(("b",), "1234")])
+        self.assertEqual(self.fs.stats().bytes, 8)
+        self.assertEqual(self.fs.stats().evictions, 1)
+
+    def test_evictOnAppend(self):
+        """
+        Growing a file through a handle can evict other files, but never the
+        file being written.
+        """
+        self.root.child("a").setContent("1234")
+        with self.root.child("b").open("a") as handle:
+            handle.write("1234567890")
+            self.assertFalse(self.root.child("a").exists())
+            self.assertTrue(self.root.child("b").exists())
+            handle.write("1")
+        self.assertFalse(self.root.child("b").exists())
+
+    def test_hitsAndMisses(self):
+        """
+        Reads of existing files count as hits, and of missing files as
+        misses.
+        """
+        self.root.child("a").setContent("1234")
+        self.root.child("a").getContent()
+        self.root.child("a").open().close()
+        self.assertRaises(KeyError, self.root.child("b").getContent)
+        self.assertRaises(IOError, self.root.child("b").open)
+        stats = self.fs.stats()
+        self.assertEqual((stats.hits, stats.misses), (2, 2))
+
+    def test_moveKeepsBudget(self):
+        """
+        Moved files are still accounted for, under their new paths.
+        """
+        self.root.child("a").child("b").setContent("1234")
+        self.root.child("c").setContent("1234")
+        self.root.child("a").moveTo(self.root.child("d"))
+        self.root.child("e").setContent("1234")
+        self.assertEqual(self.evicted, [(("c",), "1234")])
+        self.root.child("f").setContent("1234")
+        self.assertEqual(self.evicted[1], (("d", "b"), "1234"))
+
+    def test_forkKeepsBudget(self):
+        """
+        Forks of a filesystem with a budget enforce it independently.
+        """
+        self.root.child("a").setContent("1234")
+        self.root.child("b").setContent("1234")
+        fork = MemoryPath(self.fs.fork())
+        fork.child("c").setContent("1234")
+        self.assertFalse(fork.child("a").exists())
+        self.assertTrue(self.root.child("a").exists())
+
+
+class MemoryFSSpillTestCase(TestCase):
+    """
+    Tests for L{MemoryFS} spilling files to disk to stay within its budget.
+    """
+
+    def setUp(self):
+        self.spill = FilePath(mkdtemp())
+        self.addCleanup(self.spill.remove)
+        self.fs = MemoryFS(budget=10, spillTo=self.spill)
+        self.root = MemoryPath(self.fs)
+
+    def test_spill(self):
+        """
+        Files over the budget are spilled to disk instead of being evicted.
+        """
+        self.root.child("a").setContent("1234")
+        self.root.child("b").setContent("5678")
+        self.root.child("c").setContent("abcd")
+
+        self.assertTrue(self.root.child("a").exists())
+        self.assertEqual(self.root.child("a").getsize(), 4)
+        self.assertEqual(len(self.spill.children()), 1)
+        stats = self.fs.stats()
+        self.assertEqual((stats.bytes, stats.spilled), (8, 4))
+        self.assertEqual(stats.evictions, 1)
+
+    def test_unspill(self):
+        """
+        Spilled files are brought back into memory when read, spilling
+        others in their place.
+        """
+        self.root.child("a").setContent("1234")
+        self.root.child("b").setContent("5678")
+        self.root.child("c").setContent("abcd")
+
+        self.assertEqual(self.root.child("a").getContent(), "1234")
+        with self.root.child("b").open() as handle:
+            self.assertEqual(handle.read(), "5678")
+        stats = self.fs.stats()
+        self.assertEqual((stats.bytes, stats.spilled), (8, 4))
+        self.assertEqual(len(self.spill.children()), 1)
+
+    def test_appendToSpilled(self):
+        """
+        Spilled files may be appended to.
+        """
+        self.root.child("a").setContent("1234")
+        self.root.child("b").setContent("5678")
+        self.root.child("c").setContent("abcd")
+
+        with self.root.child("a").open("a") as handle:
+            handle.write("5")
+        self.assertEqual(self.root.child("a").getContent(), "12345")
+
+    def test_overwriteSpilled(self):
+        """
+        Overwriting a spilled file discards its copy on disk.
+        """
+        self.root.child("a").setContent("1234")
+        self.root.child("b").setContent("5678")
+        self.root.child("c").setContent("abcd")
+
+        self.root.child("a").setContent("1")
+        self.assertEqual(self.fs.stats().spilled, 0)
+        self.assertEqual(self.spill.children(), [])
+
+    def test_forkSharesSpills(self):
+        """
+        Forks share spilled files, which are read back independently.
+        """
+        self.root.child("a").setContent("1234")
+        self.root.child("b").setContent("5678")
+        self.root.child("c").setContent("abcd")
+
+        snapshot = MemoryPath(self.fs.snapshot())
+        self.assertEqual(self.root.child("a").getContent(), "1234")
+        self.assertEqual(snapshot.child("a").getContent(), "1234")
+        self.assertEqual(snapshot.child("a").getContent(), "1234")
+
+
+class MemoryFSImageTestCase(TestCase):
+    """
+    Tests for saving and loading images of a L{MemoryFS}.
+    """
+
+    def setUp(self):
+        temp = FilePath(mkdtemp())
+        self.addCleanup(temp.remove)
+        self.image = temp.child("image")
+
+        self.fs = MemoryFS()
+        root = MemoryPath(self.fs)
+        root.child("a").setContent("alpha")
+        root.child("empty").createDirectory()
+        root.child("sub").child("b").setContent("beta")
+        root.child("sub").child("nothing").setContent("")
+
+    def test_roundTrip(self):
+        """
+        Loading a saved image gives back the same files and directories.
+        """
+        self.fs.save(self.image)
+        root = MemoryPath(MemoryFS.load(self.image))
+
+        self.assertEqual(sorted(root.listdir()), ["a", "empty", "sub"])
+        self.assertTrue(root.child("empty").isdir())
+        self.assertEqual(root.child("empty").listdir(), [])
+        self.assertEqual(root.child("a").getContent(), "alpha")
+        self.assertEqual(root.child("sub").child("b").getContent(), "beta")
+        self.assertEqual(root.child("sub").child("nothing").getContent(), "")
+
+    def test_unicode(self):
+        """
+        Unicode names, including those beside or below L{str} names with
+        bytes outside of ASCII, keep their types through an image.
+        """
+        root = MemoryPath(self.fs)
+        snowman = u"\N{SNOWMAN}"
+        root.child(snowman).child("b").setContent("unicode above")
+        root.child("caf\xe9").child(snowman).setContent("str above")
+        root.child("caf\xe9").child("x").setContent("str")
+        self.fs.save(self.image)
+        loaded = MemoryPath(MemoryFS.load(self.image))
+
+        self.assertEqual(loaded.child(snowman).child("b").getContent(),
+                         "unicode above")
+        self.assertEqual(
+            loaded.child("caf\xe9").child(snowman).getContent(), "str above")
+        self.assertEqual(
+            sorted(map(type, loaded.child("caf\xe9").listdir())),
+            [str, unicode])
+        self.assertEqual(sorted(map(type, loaded.listdir())),
+                         [str, str, str, str, unicode])
+
+    def test_lazy(self):
+        """
+        Loaded files are not held in memory until they are used, but can be
+        measured before then.
+        """
+        self.fs.save(self.image)
+        fs = MemoryFS.load(self.image)
+        root = MemoryPath(fs)
+
+        self.assertEqual(root.child("a").getsize(), 5)
+        self.assertEqual(fs.stats().bytes, 0)
+        root.child("a").getContent()
+        self.assertEqual(fs.stats().bytes, 5)
+
+    def test_writeLoaded(self):
+        """
+        Loaded files may be changed without changing the image.
+        """
+        self.fs.save(self.image)
+        root = MemoryPath(MemoryFS.load(self.image))
+        with root.child("a").open("a") as handle:
+            handle.write("bet")
+        root.child("sub").child("b").open("w").close()
+
+        again = MemoryPath(MemoryFS.load(self.image))
+        self.assertEqual(root.child("a").getContent(), "alphabet")
+        self.assertEqual(root.child("sub").child("b").getContent(), "")
+        self.assertEqual(again.child("a").getContent(), "alpha")
+        self.assertEqual(again.child("sub").child("b").getContent(), "beta")
+
+    def test_loadOptions(self):
+        """
+        Loading passes any options along to the new filesystem.
+        """
+        self.fs.save(self.image)
+        fs = MemoryFS.load(self.image, budget=6)
+        root = MemoryPath(fs)
+        root.child("a").getContent()
+        root.child("sub").child("b").getContent()
+        self.assertEqual(fs.stats().evictions, 1)
+        self.assertFalse(root.child("a").exists())
+
+    def test_share(self):
+        """
+        A shared copy of a filesystem holds the same files, without copying
+        their contents into memory.
+        """
+        fs = self.fs.share()
+        root = MemoryPath(fs)
+        self.assertEqual(fs.stats().bytes, 0)
+        self.assertEqual(sorted(root.listdir()), ["a", "empty", "sub"])
+        self.assertEqual(root.child("sub").child("b").getContent(), "beta")
+
+    def test_shareReads(self):
+        """
+        Reading files from a shared filesystem leaves them in the mapping,
+        while writing to them copies them.
+        """
+        fs = self.fs.share()
+        root = MemoryPath(fs)
+        self.assertEqual(root.child("a").getContent(), "alpha")
+        with root.child("sub").child("b").open() as handle:
+            self.assertEqual(handle.read(), "beta")
+        self.assertEqual(root.child("a").getContent(), "alpha")
+        self.assertEqual(fs.stats().bytes, 0)
+
+        with root.child("a").open("a") as handle:
+            handle.write("bet")
+        self.assertEqual(root.child("a").getContent(), "alphabet")
+        self.assertEqual(fs.stats().bytes, 8)
+
+    def test_shareWithChild(self):
+        """
+        Processes forked after sharing a filesystem can read it.
+        """
+        root = MemoryPath(self.fs.share())
+        r, w = os.pipe()
+        pid = os.fork()
+        if not pid:
+            try:
+                os.close(r)
+                os.write(w, root.child("sub").child("b").getContent())
+            finally:
+                os._exit(0)
+        os.close(w)
+        try:
+            self.assertEqual(os.read(r, 100), "beta")
+        finally:
+            os.close(r)
+            os.waitpid(pid, 0)
+
+    def test_notAnImage(self):
+        """
+        Loading something which isn't an image raises L{ValueError}.
+        """
+        self.image.setContent("x" * 64)
+        self.assertRaises(ValueError, MemoryFS.load, self.image)
+
+
+class MemoryFSCompressionTestCase(TestCase):
+    """
+    Tests for L{MemoryFS} compressing large files.
+    """
+
+    def setUp(self):
+        self.text = "all work and no play " * 50
+        self.fs = MemoryFS(compressAbove=100, hotBytes=len(self.text))
+        self.root = MemoryPath(self.fs)
+
+    def test_compress(self):
+        """
+        Files at least as large as the threshold are held compressed, but
+        still read back and report their full size.
+        """
+        self.root.child("big").setContent(self.text)
+        self.root.child("small").setContent("x" * 99)
+
+        self.assertTrue(self.fs.stats().bytes < len(self.text))
+        self.assertEqual(self.root.child("big").getsize(), len(self.text))
+        self.assertEqual(self.root.child("big").getContent(), self.text)
+        with self.root.child("big").open() as handle:
+            self.assertEqual(handle.read(), self.text)
+
+    def test_hotBytes(self):
+        """
+        The most recently read compressed files are kept decompressed, up to
+        a number of bytes.
+        """
+        self.root.child("a").setContent(self.text)
+        self.root.child("b").setContent(self.text.upper())
+        self.assertEqual(len(self.fs._hot), 0)
+
+        self.assertIdentical(self.root.child("b").getContent(),
+                             self.root.child("b").getContent())
+        self.root.child("a").getContent()
+        self.assertEqual(self.fs._hot.values(), [self.text])
+
+    def test_hotTooBig(self):
+        """
+        Compressed files larger than the whole cache aren't kept
+        decompressed.
+        """
+        self.root.child("a").setContent(self.text + "!")
+        self.root.child("a").getContent()
+        self.assertEqual(len(self.fs._hot), 0)
+
+    def test_hotCounted(self):
+        """
+        Decompressed contents count towards the bytes held, until the file
+        holding them goes away.
+        """
+        self.root.child("a").setContent(self.text)
+        compressed = self.fs.stats().bytes
+        self.root.child("a").getContent()
+        self.assertEqual(self.fs.stats().bytes, compressed + len(self.text))
+        self.root.child("a").setContent("x")
+        self.assertEqual(self.fs.stats().bytes, 1)
+        self.assertEqual(len(self.fs._hot), 0)
+
+    def test_hotEvictedFirst(self):
+        """
+        Decompressed contents are forgotten before any file is evicted to
+        meet the budget.
+        """
+        self.fs = MemoryFS(budget=len(self.text), compressAbove=100,
+                           hotBytes=len(self.text))
+        self.root = MemoryPath(self.fs)
+        self.root.child("a").setContent(self.text)
+        self.root.child("a").getContent()
+        self.root.child("b").setContent("small")
+        self.assertEqual(len(self.fs._hot), 0)
+        self.assertTrue(self.root.child("a").exists())
+        self.assertTrue(self.fs.stats().bytes <= len(self.text))
+
+    def test_writeCompressed(self):
+        """
+        Compressed files are decompressed to be written to, and compressed
+        again once read.
+        """
+        self.root.child("a").setContent(self.text)
+        with self.root.child("a").open("a") as handle:
+            handle.write("!")
+            self.assertEqual(self.fs.stats().bytes, len(self.text) + 1)
+        self.assertEqual(self.root.child("a").getContent(), self.text + "!")
+        self.assertTrue(self.fs.stats().bytes < len(self.text))
+
+    def test_budget(self):
+        """
+        Budgets apply to the compressed sizes of files.
+        """
+        fs = MemoryFS(budget=len(self.text), compressAbove=100)
+        root = MemoryPath(fs)
+        for name in "abc":
+            root.child(name).setContent(self.text)
+        self.assertEqual(fs.stats().evictions, 0)
+        self.assertEqual(root.child("c").getContent(), self.text)
+
+
+class MemoryFSDedupTestCase(TestCase):
+    """
+    Tests for L{MemoryFS} deduplicating file contents.
+    """
+
+    def setUp(self):
+        self.fs = MemoryFS(dedup=True)
+        self.root = MemoryPath(self.fs)
+
+    def test_shared(self):
+        """
+        Files with the same contents share them.
+        """
+        self.root.child("a").setContent("12345")
+        self.root.child("sub").child("b").setContent("12345")
+        self.root.child("c").setContent("678")
+
+        self.assertIdentical(self.root.child("a").getContent(),
+                      self.root.child("sub").child("b").getContent())
+        stats = self.fs.stats()
+        self.assertEqual((stats.bytes, stats.blobs, stats.deduplicated),
+                         (8, 2, 5))
+
+    def test_release(self):
+        """
+        Contents are stored until the last file holding them goes away.
+        """
+        self.root.child("a").setContent("12345")
+        self.root.child("b").setContent("12345")
+        self.root.child("a").setContent("")
+        self.assertEqual(self.fs.stats().bytes, 5)
+        self.root.child("b").open("w").close()
+        stats = self.fs.stats()
+        self.assertEqual((stats.bytes, stats.blobs, stats.deduplicated),
+                         (0, 1, 0))
+
+    def test_writeShared(self):
+        """
+        Writing to a file with shared contents leaves the other files alone,
+        and shares the new contents once they are read.
+        """
+        self.root.child("a").setContent("12345")
+        self.root.child("b").setContent("12345")
+        self.root.child("c").setContent("123456")
+        with self.root.child("a").open("a") as handle:
+            handle.write("6")
+        self.assertEqual(self.root.child("b").getContent(), "12345")
+        self.assertEqual(self.root.child("a").getContent(), "123456")
+        stats = self.fs.stats()
+        self.assertEqual((stats.bytes, stats.blobs, stats.deduplicated),
+                         (11, 2, 6))
+
+    def test_fork(self):
+        """
+        Forks keep their own counts of how many files hold each contents.
+        """
+        self.root.child("a").setContent("12345")
+        forked = self.fs.fork()
+        MemoryPath(forked).child("b").setContent("12345")
+        self.root.child("a").setContent("")
+        self.assertEqual(self.fs.stats().deduplicated, 0)
+        self.assertEqual(forked.getContent(("a",)), "12345")
+        self.assertEqual(forked.stats().deduplicated, 5)
+
+
+class MemoryFSThreadingTestCase(TestCase):
+    """
+    Tests for sharing a L{MemoryFS} between threads.
+    """
+
+    def setUp(self):
+        interval = sys.getcheckinterval()
+        self.addCleanup(sys.setcheckinterval, interval)
+        # Switch threads as often as possible, to shake out races.
+        sys.setcheckinterval(1)
+
+    def runThreads(self, f, count=8):
+        errors = []
+
+        def run(i):
+            try:
+                f(i)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [Thread(target=run, args=(i,)) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def assertCounts(self, fs):
+        """
+        The counts of files and bytes kept by a filesystem match what is
+        actually in it.
+        """
+        files = [p for p in MemoryPath(fs).walk() if p.isfile()]
+        stats = fs.stats()
+        self.assertEqual(stats.files, len(files))
+        self.assertEqual(stats.bytes,
+                         sum(len(p.getContent()) for p in files))
+
+    def test_concurrentWriters(self):
+        """
+        Threads may create and fill files throughout a tree at once, and
+        every file and byte is accounted for.
+        """
+        fs = MemoryFS()
+        root = MemoryPath(fs)
+
+        def work(i):
+            for j in range(50):
+                d = root.child(str(j % 5)).child(str(i))
+                d.child(str(j)).setContent("x" * j)
+                with root.child("shared").open("a") as handle:
+                    handle.write("y")
+
+        self.runThreads(work)
+        self.assertEqual(root.child("shared").getsize(), 8 * 50)
+        total = sum(len(p.getContent()) for p in root.walk() if p.isfile())
+        self.assertEqual(fs.stats().bytes, total)
+
+    def test_concurrentRemoval(self):
+        """
+        Files being opened for writing are either not removed, or removed
+        before they are opened, so that nothing is written to a file which
+        isn't there.
+        """
+        fs = MemoryFS()
+        root = MemoryPath(fs)
+        lost = []
+
+        def work(i):
+            for j in range(1000):
+                f = root.child("dir").child("file")
+                if i % 2:
+                    try:
+                        f.parent().remove()
+                    except OSError:
+                        pass
+                    continue
+                try:
+                    with f.open("a") as handle:
+                        handle.write("x")
+                        if "x" not in f.getContent():
+                            lost.append(f)
+                except (IOError, KeyError) as e:
+                    lost.append(e)
+
+        self.runThreads(work)
+        self.assertEqual(lost, [])
+
+    def test_concurrentCounts(self):
+        """
+        Operations from many threads are all counted.
+        """
+        fs = MemoryFS()
+        root = MemoryPath(fs)
+
+        def work(i):
+            for j in range(50):
+                f = root.child(str(j % 5)).child(str(i))
+                f.setContent("x")
+                f.getContent()
+                f.parent().listdir()
+
+        self.runThreads(work)
+        stats = fs.stats()
+        self.assertEqual((stats.writes, stats.reads, stats.listdirs),
+                         (400, 400, 400))
+
+    def test_writeWhileRemoving(self):
+        """
+        Files written into directories as they are removed are either
+        removed with them, or written into new directories, and are
+        accounted for either way.
+        """
+        fs = MemoryFS()
+        root = MemoryPath(fs)
+
+        def work(i):
+            for j in range(1000):
+                d = root.child(str(j % 3))
+                if i == 0:
+                    try:
+                        d.remove()
+                    except OSError:
+                        pass
+                else:
+                    d.child(str(i)).setContent("x" * i)
+
+        self.runThreads(work, count=4)
+        self.assertCounts(fs)
+
+    def test_evictWhileRemoving(self):
+        """
+        Files may be evicted while the directories holding them are removed.
+        """
+        fs = MemoryFS(budget=200)
+        root = MemoryPath(fs)
+
+        def work(i):
+            for j in range(1000):
+                d = root.child(str(j % 3))
+                if i == 0:
+                    try:
+                        d.remove()
+                    except OSError:
+                        pass
+                else:
+                    d.child(str(j)).setContent("x" * 20)
+
+        self.runThreads(work, count=4)
+        self.assertCounts(fs)
+        self.assertTrue(fs.stats().bytes <= 200)
+
+    def test_evictionHookUnlocked(self):
+        """
+        The eviction hook is called without holding the filesystem's shared
+        locks, so other threads can carry on meanwhile.
+        """
+        stats = []
+
+        def onEvict(path, content):
+            thread = Thread(target=lambda: stats.append(fs.stats()))
+            thread.start()
+            thread.join(5)
+
+        fs = MemoryFS(budget=4, onEvict=onEvict)
+        root = MemoryPath(fs)
+        root.child("a").setContent("1234")
+        root.child("b").setContent("1234")
+        self.assertEqual(len(stats), 1)
+
+    def test_concurrentEviction(self):
+        """
+        Threads may push each other's files out of a budget.
+        """
+        fs = MemoryFS(budget=1000, dedup=True)
+        root = MemoryPath(fs)
+
+        def work(i):
+            for j in range(100):
+                root.child(str(i)).child(str(j)).setContent(str(j) * 50)
+                try:
+                    root.child(str(i)).child(str(j - 1)).getContent()
+                except KeyError:
+                    pass
+
+        self.runThreads(work)
+        stored = set(p.getContent() for p in root.walk() if p.isfile())
+        self.assertEqual(fs.stats().bytes,
+                         sum(len(content) for content in stored))
+        self.assertTrue(fs.stats().bytes <= 1000)
+
+    def test_forkWhileWriting(self):
+        """
+        Forking while other threads write gives a consistent fork.
+        """
+        fs = MemoryFS()
+        root = MemoryPath(fs)
+        forks = []
+
+        def work(i):
+            for j in range(20):
+                root.child(str(i)).child(str(j)).setContent("x")
+                if i == 0:
+                    forks.append(fs.fork())
+
+        self.runThreads(work)
+        for fork in forks:
+            files = [p for p in MemoryPath(fork).walk() if p.isfile()]
+            self.assertEqual(fork.stats().bytes, len(files))
+
+
+class MemoryFSTreeTestCase(TestCase):
+    """
+    Tests for copying trees between L{MemoryFS} and the disk.
+    """
+
+    def setUp(self):
+        self.temp = FilePath(mkdtemp())
+        self.addCleanup(self.temp.remove)
+        self.source = self.temp.child("source")
+        self.source.child("sub").child("deeper").makedirs()
+        self.source.child("empty").createDirectory()
+        self.source.child("a").setContent("alpha")
+        self.source.child("sub").child("b").setContent("beta" * 100)
+        self.source.child("sub").child("deeper").child("c").setContent("")
+
+    def assertTree(self, root):
+        self.assertEqual(sorted(root.listdir()), ["a", "empty", "sub"])
+        self.assertEqual(root.child("empty").listdir(), [])
+        self.assertEqual(root.child("a").getContent(), "alpha")
+        self.assertEqual(root.child("sub").child("b").getContent(),
+                         "beta" * 100)
+        c = root.child("sub").child("deeper").child("c")
+        self.assertEqual(c.getContent(), "")
+
+    def test_importTree(self):
+        """
+        Importing a tree copies its files and directories.
+        """
+        fs = MemoryFS()
+        fs.importTree(self.source, workers=4)
+        self.assertTree(MemoryPath(fs))
+
+    def test_importTreeMapped(self):
+        """
+        Large files may be mapped instead of read.
+        """
+        fs = MemoryFS()
+        fs.importTree(self.source, mapAbove=100)
+        self.assertEqual(fs.stats().bytes, 5)
+        self.assertTree(MemoryPath(fs))
+
+    def test_importSymlinks(self):
+        """
+        Symlinks to files are followed, and symlinks to directories are
+        skipped.
+        """
+        self.source.child("a").linkTo(self.source.child("link"))
+        self.source.child("sub").linkTo(self.source.child("dirlink"))
+        self.source.child("gone").linkTo(self.source.child("dangling"))
+        fs = MemoryFS()
+        fs.importTree(self.source)
+        root = MemoryPath(fs)
+        self.assertEqual(root.child("link").getContent(), "alpha")
+        self.assertFalse(root.child("dirlink").exists())
+        self.assertFalse(root.child("dangling").exists())
+
+    def test_exportTree(self):
+        """
+        Exporting a filesystem writes out its files and directories.
+        """
+        fs = MemoryFS()
+        fs.importTree(self.source)
+        destination = self.temp.child("destination")
+        fs.exportTree(destination, workers=4)
+        self.assertTree(destination)
+
+    def test_exportTreeInsecure(self):
+        """
+        Nothing is exported from a filesystem with a path which would put it
+        outside of the destination.
+        """
+        fs = MemoryFS()
+        root = MemoryPath(fs)
+        root.child("a").setContent("a")
+        root.child("..").child("escaped").setContent("escaped")
+        destination = self.temp.child("destination")
+        self.assertRaises(InsecurePath, fs.exportTree, destination)
+        self.assertFalse(destination.exists())
+        self.assertFalse(self.temp.child("escaped").exists())
+
+
+class MemoryFSStatsTestCase(TestCase):
+    """
+    Tests for the statistics kept by L{MemoryFS}.
+    """
+
+    def setUp(self):
+        self.fs = MemoryFS()
+        self.root = MemoryPath(self.fs)
+
+    def assertCounts(self, fs):
+        """
+        The counts of files, directories and bytes kept by a filesystem match
+        what is actually in it.
+        """
+        root = MemoryPath(fs)
+        paths = list(root.walk())[1:]
+        files = [p for p in paths if p.isfile()]
+        stats = fs.stats()
+        self.assertEqual(stats.files, len(files))
+        self.assertEqual(stats.directories, len(paths) - len(files))
+        self.assertEqual(stats.logical, sum(p.getsize() for p in files))
+
+    def test_counts(self):
+        """
+        Files, directories and their sizes are counted as the tree changes.
+        """
+        self.root.child("a").child("b").child("c").setContent("123")
+        self.root.child("d").createDirectory()
+        with self.root.child("d").child("e").open("a") as handle:
+            handle.write("4567")
+        self.assertCounts(self.fs)
+        stats = self.fs.stats()
+        self.assertEqual((stats.files, stats.directories, stats.logical),
+                         (2, 3, 7))
+
+        d = self.root.child("d")
+        self.root.child("a").child("b").moveTo(d.child("b"))
+        d.child("e").moveTo(d.child("b").child("c"))
+        self.assertCounts(self.fs)
+        self.root.child("d").remove()
+        self.assertCounts(self.fs)
+        stats = self.fs.stats()
+        self.assertEqual((stats.files, stats.directories, stats.logical),
+                         (0, 1, 0))
+
+    def test_countsWithBudget(self):
+        """
+        Evicted and spilled files are counted correctly.
+        """
+        spill = FilePath(mkdtemp())
+        self.addCleanup(spill.remove)
+        for fs in MemoryFS(budget=5), MemoryFS(budget=5, spillTo=spill):
+            root = MemoryPath(fs)
+            root.child("a").setContent("1234")
+            root.child("b").setContent("5678")
+            self.assertCounts(fs)
+
+    def test_countsLoaded(self):
+        """
+        Loaded images are counted without reading their contents.
+        """
+        temp = FilePath(mkdtemp())
+        self.addCleanup(temp.remove)
+        self.root.child("a").child("b").setContent("123")
+        self.root.child("c").setContent("4567")
+        self.fs.save(temp.child("image"))
+        fs = MemoryFS.load(temp.child("image"))
+        stats = fs.stats()
+        self.assertEqual((stats.files, stats.directories, stats.logical),
+                         (2, 1, 7))
+        self.assertCounts(fs)
+
+    def test_resident(self):
+        """
+        The estimate of resident memory counts the index and every file as
+        well as their contents.
+        """
+        empty = self.fs.stats()
+        self.assertEqual((empty.resident, empty.index), (0, 0))
+        self.root.child("a").child("b").setContent("123")
+        stats = self.fs.stats()
+        self.assertTrue(stats.index > 0)
+        self.assertTrue(stats.resident > stats.index + stats.bytes)
+
+    def test_residentBookkeeping(self):
+        """
+        The estimate of resident memory counts what is kept to deduplicate
+        and evict files and to cache decompressed files.
+        """
+        def overhead(fs):
+            root = MemoryPath(fs)
+            root.child("a").setContent("x" * 100)
+            root.child("a").getContent()
+            stats = fs.stats()
+            return stats.resident - stats.bytes
+
+        plain = overhead(self.fs)
+        for fs in [MemoryFS(dedup=True), MemoryFS(budget=1000),
+                   MemoryFS(compressAbove=10)]:
+            self.assertTrue(overhead(fs) > plain)
+
+    def test_operations(self):
+        """
+        Opens, reads, writes and listings are counted.
+        """
+        self.root.child("a").setContent("123")
+        with self.root.child("a").open("a") as handle:
+            handle.write("4")
+            handle.write("5")
+        self.root.child("a").getContent()
+        self.root.child("a").open().close()
+        self.root.listdir()
+        stats = self.fs.stats()
+        self.assertEqual(
+            (stats.opens, stats.reads, stats.writes, stats.listdirs),
+            (2, 2, 3, 1))
@@ -980,6 +980,431 @@ class FilePathTestCase(AbstractFilePathTestCase):
         exc = self.assertRaises(OSError, path.copyTo, b'some other path')
         self.assertEqual(exc.errno, errno.ENOENT)
 
+    def test_copyToSparse(self):
+        """
+        L{FilePath.copyTo} copies a sparse file without filling in its holes.
+        """
+        if isWindows:
+            raise SkipTest("Sparse files are not supported on Windows.")
+        source = self.path.child(b"sparse")
+        with contextlib.closing(source.open("w")) as f:
+            f.seek(2 ** 20)
+            f.write(b"middle")
+            f.seek(3 * 2 ** 20)
+            f.write(b"end")
+            f.truncate(5 * 2 ** 20)
+        if os.stat(source.path).st_blocks * 512 >= 5 * 2 ** 20:
+            raise SkipTest("Filesystem does not support sparse files.")
+
+        destination = self.path.child(b"sparse.copy")
+        source.copyTo(destination)
+
+        self.assertEqual(destination.getsize(), 5 * 2 ** 20)
+        self.assertEqual(destination.getContent(), source.getContent())
+        self.assertTrue(
+            os.stat(destination.path).st_blocks * 512 < 5 * 2 ** 20)
+
+    def test_copyToHardLinks(self):
+        """
+        L{FilePath.copyTo} with C{hardLinks} set copies a file with several
+        links once, and re-creates the other links to it as hard links.
+        """
+        if isWindows:
+            raise SkipTest("Hard link counts are not available on Windows.")
+        original = self.path.child(b"sub1").child(b"file2")
+        os.link(original.path, self.path.child(b"sub3").child(b"file2").path)
+
+        fp = filepath.FilePath(self.mktemp())
+        self.path.copyTo(fp, hardLinks=True)
+
+        first = fp.child(b"sub1").child(b"file2")
+        second = fp.child(b"sub3").child(b"file2")
+        self.assertEqual(first.getContent(), self.f2content)
+        self.assertEqual(first.getInodeNumber(), second.getInodeNumber())
+        self.assertEqual(first.getNumberOfHardLinks(), 2)
+        self.assertEqual(fp.child(b"file1").getNumberOfHardLinks(), 1)
+
+    def test_copyToHardLinksAgain(self):
+        """
+        Copying with C{hardLinks} set over an earlier such copy doesn't write
+        through links which no longer exist in the source.
+        """
+        if isWindows:
+            raise SkipTest("Hard link counts are not available on Windows.")
+        original = self.path.child(b"sub1").child(b"file2")
+        linked = self.path.child(b"sub3").child(b"file2")
+        os.link(original.path, linked.path)
+        fp = filepath.FilePath(self.mktemp())
+        self.path.copyTo(fp, hardLinks=True)
+
+        linked.setContent(b"unlinked")
+        self.path.copyTo(fp, hardLinks=True)
+
+        self.assertEqual(fp.child(b"sub1").child(b"file2").getContent(),
+                         self.f2content)
+        self.assertEqual(fp.child(b"sub3").child(b"file2").getContent(),
+                         b"unlinked")
+
+    def test_copyToWithoutHardLinks(self):
+        """
+        By default, L{FilePath.copyTo} copies each hard link as an independent
+        file.
+        """
+        if isWindows:
+            raise SkipTest("Hard link counts are not available on Windows.")
+        original = self.path.child(b"sub1").child(b"file2")
+        os.link(original.path, self.path.child(b"sub3").child(b"file2").path)
+
+        fp = filepath.FilePath(self.mktemp())
+        self.path.copyTo(fp)
+
+        self.assertEqual(
+            fp.child(b"sub1").child(b"file2").getNumberOfHardLinks(), 1)
+
+    def test_diskUsageApparent(self):
+        """
+        L{FilePath.diskUsage} with C{apparent} set adds up the sizes of every
+        entry in the tree, and reports the total for each directory.
+        """
+        sub1 = self.path.child(b"sub1")
+        sub3 = self.path.child(b"sub3")
+        usage = self.path.diskUsage(apparent=True)
+
+        self.assertEqual(usage.files, 5)
+        self.assertEqual(set(usage.directories), set([self.path, sub1, sub3]))
+        self.assertEqual(usage.directories[sub1],
+                         os.lstat(sub1.path).st_size + len(self.f2content))
+        self.assertEqual(usage.directories[sub3], os.lstat(sub3.path).st_size)
+        self.assertEqual(usage.size, usage.directories[self.path])
+        self.assertEqual(usage.size,
+                         os.lstat(self.path.path).st_size +
+                         len(self.f1content) + usage.directories[sub1] +
+                         usage.directories[sub3])
+
+    def test_diskUsageWorkers(self):
+        """
+        L{FilePath.diskUsage} gives the same answer when spread across
+        several threads.
+        """
+        self.path.child(b"sub1").child(b"deeper").createDirectory()
+        self.assertEqual(self.path.diskUsage(workers=4),
+                         self.path.diskUsage())
+
+    def test_diskUsageHardLinks(self):
+        """
+        L{FilePath.diskUsage} only counts a file with several hard links in
+        the tree once.
+        """
+        if isWindows:
+            raise SkipTest("Hard links are not counted on Windows.")
+        sub3 = self.path.child(b"sub3")
+        before = self.path.diskUsage(apparent=True)
+        sub3Before = os.lstat(sub3.path).st_size
+        os.link(self.path.child(b"file1").path, sub3.child(b"file1").path)
+        after = self.path.diskUsage(apparent=True)
+        # Adding an entry may have grown the directory itself.
+        sub3Growth = os.lstat(sub3.path).st_size - sub3Before
+        self.assertEqual(after.files, before.files)
+        self.assertEqual(after.size, before.size + sub3Growth)
+
+    def test_diskUsageSparse(self):
+        """
+        L{FilePath.diskUsage} counts the blocks allocated to a sparse file,
+        rather than its size, unless C{apparent} is set.
+        """
+        sparse = self.path.child(b"sparse")
+        with sparse.open("w") as f:
+            f.truncate(1024 * 1024)
+        st = os.lstat(sparse.path)
+        if not hasattr(st, "st_blocks"):
+            raise SkipTest("Allocated blocks are not known on this platform.")
+        self.assertEqual(sparse.diskUsage().size, st.st_blocks * 512)
+        self.assertEqual(sparse.diskUsage(apparent=True).size, 1024 * 1024)
+
+    def test_diskUsageFile(self):
+        """
+        L{FilePath.diskUsage} of a file is the usage of that file alone.
+        """
+        usage = self.path.child(b"file1").diskUsage(apparent=True)
+        self.assertEqual(usage, (len(self.f1content), 1, {}, []))
+
+    def test_diskUsageErrors(self):
+        """
+        L{FilePath.diskUsage} leaves out and reports entries which can't be
+        examined and directories which can't be listed, and measures the
+        rest of the tree.
+        """
+        sub1 = self.path.child(b"sub1")
+        sub3 = self.path.child(b"sub3")
+        file1 = self.path.child(b"file1")
+        lstat, listdir = os.lstat, filepath.listdir
+
+        def brokenLstat(path):
+            if path == file1.path:
+                raise OSError(errno.ENOENT, "vanished", path)
+            return lstat(path)
+
+        def brokenListdir(path):
+            if path == sub1.path:
+                raise OSError(errno.EACCES, "denied", path)
+            return listdir(path)
+
+        before = self.path.diskUsage(apparent=True)
+        self.patch(os, "lstat", brokenLstat)
+        self.patch(filepath, "listdir", brokenListdir)
+        usage = self.path.diskUsage(apparent=True)
+
+        self.assertEqual(sorted(usage.errors), sorted([file1, sub1]))
+        self.assertEqual(usage.files, before.files - 2)
+        self.assertEqual(usage.directories[sub1], lstat(sub1.path).st_size)
+        self.assertEqual(usage.directories[sub3], before.directories[sub3])
+        self.assertEqual(usage.size, before.size - len(self.f1content) -
+                         len(self.f2content))
+
+    def test_deltaCopyTo(self):
+        """
+        L{FilePath.deltaCopyTo} replaces the contents of an existing file with
+        those of the source.
+        """
+        blockSize = filepath.FilePath._chunkSize
+        source = self.path.child(b"big")
+        old = b"".join(chr(i % 251) for i in range(blockSize * 3))
+        source.setContent(old[:blockSize] + b"changed" + old[blockSize:])
+        destination = self.path.child(b"big.copy")
+        destination.setContent(old)
+
+        source.deltaCopyTo(destination)
+
+        self.assertEqual(destination.getContent(), source.getContent())
+        self.assertEqual(sorted(self.path.listdir()),
+                         [b"big", b"big.copy", b"file1", b"sub1", b"sub3"])
+
+    def test_deltaCopyToWritesChangedBlocks(self):
+        """
+        L{FilePath.deltaCopyTo} updates the destination in place, writing
+        only the blocks which differ from the source.
+        """
+        blockSize = filepath.FilePath._chunkSize
+        source = self.path.child(b"big")
+        old = b"".join(chr(i % 251) for i in range(blockSize * 4))
+        new = old[:blockSize + 10] + b"changed" + old[blockSize + 17:]
+        source.setContent(new)
+        destination = self.path.child(b"big.copy")
+        destination.setContent(old)
+        inode = destination.getInodeNumber()
+
+        written = []
+        def open(mode='r'):
+            f = filepath.FilePath.open(destination, mode)
+            write = f.write
+            class Recorder(object):
+                def __getattr__(self, name):
+                    return getattr(f, name)
+                def write(self, data):
+                    written.append(len(data))
+                    write(data)
+            return Recorder()
+        destination.open = open
+
+        source.deltaCopyTo(destination)
+
+        self.assertEqual(written, [blockSize])
+        self.assertEqual(destination.getContent(), new)
+        self.assertEqual(destination.getInodeNumber(), inode)
+
+    def test_deltaCopyToResizes(self):
+        """
+        L{FilePath.deltaCopyTo} truncates or extends the destination to the
+        size of the source.
+        """
+        blockSize = filepath.FilePath._chunkSize
+        old = b"".join(chr(i % 251) for i in range(blockSize * 2 + 5))
+        source = self.path.child(b"big")
+        destination = self.path.child(b"big.copy")
+        for new in [old[:blockSize + 3], old + b"tail", b""]:
+            destination.setContent(old)
+            source.setContent(new)
+            source.deltaCopyTo(destination)
+            self.assertEqual(destination.getContent(), new)
+
+    def test_deltaCopyToMissingDestination(self):
+        """
+        L{FilePath.deltaCopyTo} makes a plain copy if the destination does not
+        exist yet.
+        """
+        destination = filepath.FilePath(self.mktemp())
+        self.path.child(b"file1").deltaCopyTo(destination)
+        self.assertEqual(destination.getContent(), self.f1content)
+
+    def test_copyToDelta(self):
+        """
+        L{FilePath.copyTo} with C{delta} set copies directories, updating
+        existing files in place.
+        """
+        fp = filepath.FilePath(self.mktemp())
+        self.path.copyTo(fp)
+        fp.child(b"sub1").child(b"file2").setContent(b"stale")
+        self.path.copyTo(fp, delta=True)
+        self.assertEqual(fp.child(b"sub1").child(b"file2").getContent(),
+                         self.f2content)
+
+    def test_copyToDeltaHardLinks(self):
+        """
+        L{FilePath.copyTo} with both C{delta} and C{hardLinks} set does not
+        update a file in place when other files are linked to it.
+        """
+        if isWindows:
+            raise SkipTest("Hard link counts are not available on Windows.")
+        fp = filepath.FilePath(self.mktemp())
+        self.path.copyTo(fp)
+        target = fp.child(b"file1")
+        other = fp.child(b"other")
+        target.setContent(b"stale")
+        os.link(target.path, other.path)
+        self.path.copyTo(fp, delta=True, hardLinks=True)
+        self.assertEqual(target.getContent(), self.f1content)
+        self.assertEqual(other.getContent(), b"stale")
+
+    def test_syncToDirectory(self):
+        """
+        L{FilePath.syncTo} makes a copy of all the contents of the directory
+        named by that L{FilePath}, even if the destination does not exist.
+        """
+        fp = filepath.FilePath(self.mktemp())
+        self.path.syncTo(fp, workers=4)
+        self.assertEqual(
+            sorted(x.segmentsFrom(self.path) for x in self.path.walk()
+                   if x != self.path),
+            sorted(x.segmentsFrom(fp) for x in fp.walk() if x != fp))
+        self.assertEqual(fp.child(b"sub1").child(b"file2").getContent(),
+                         self.f2content)
+
+    def test_syncToSkipsUnchanged(self):
+        """
+        L{FilePath.syncTo} does not copy files whose size and modification
+        time match their destinations, but does copy files which differ.
+        """
+        fp = filepath.FilePath(self.mktemp())
+        self.path.syncTo(fp)
+        # Same size and mtime as the source, but different bytes.
+        stale = fp.child(b"file1")
+        stale.setContent(b"FILE 1")
+        os.utime(stale.path, (self.now, self.now))
+        os.utime(self.path.child(b"file1").path, (self.now, self.now))
+        self.path.child(b"sub1").child(b"file2").setContent(b"new file 2")
+
+        self.path.syncTo(fp)
+
+        self.assertEqual(fp.child(b"file1").getContent(), b"FILE 1")
+        self.assertEqual(fp.child(b"sub1").child(b"file2").getContent(),
+                         b"new file 2")
+
+    def test_syncToTwice(self):
+        """
+        Syncing a tree again, with nothing changed, copies nothing, even
+        though modification times are only copied to the microsecond.
+        """
+        source = filepath.FilePath(self.mktemp())
+        source.child(b"sub").makedirs()
+        source.child(b"file").setContent(b"file")
+        source.child(b"sub").child(b"file").setContent(b"sub file")
+        fp = filepath.FilePath(self.mktemp())
+        source.syncTo(fp)
+
+        copied = []
+        self.patch(filepath.FilePath, "copyTo",
+                   lambda self, destination, **kw: copied.append(self))
+        source.syncTo(fp)
+
+        self.assertEqual(copied, [])
+
+    def test_syncToSymlinks(self):
+        """
+        L{FilePath.syncTo} replaces symlinks in the destination, rather than
+        changing what they point to.
+        """
+        if not getattr(os, "symlink", None):
+            raise SkipTest("Platform does not support symlinks")
+        source = filepath.FilePath(self.mktemp())
+        source.child(b"sub").makedirs()
+        source.child(b"sub").child(b"f").setContent(b"f")
+        source.child(b"file").setContent(b"file")
+        outside = filepath.FilePath(self.mktemp())
+        outside.makedirs()
+        outside.child(b"precious").setContent(b"precious")
+        fp = filepath.FilePath(self.mktemp())
+        fp.makedirs()
+        os.symlink(outside.path, fp.child(b"sub").path)
+        os.symlink(outside.child(b"precious").path, fp.child(b"file").path)
+
+        source.syncTo(fp, delete=True)
+
+        self.assertEqual(outside.listdir(), [b"precious"])
+        self.assertEqual(outside.child(b"precious").getContent(), b"precious")
+        self.assertFalse(fp.child(b"sub").islink())
+        self.assertFalse(fp.child(b"file").islink())
+        self.assertEqual(fp.child(b"sub").child(b"f").getContent(), b"f")
+        self.assertEqual(fp.child(b"file").getContent(), b"file")
+
+    def test_syncToChecksum(self):
+        """
+        L{FilePath.syncTo} compares file contents by digest when C{checksum}
+        is set, so same-sized files with equal modification times are still
+        copied if their contents differ.
+        """
+        fp = filepath.FilePath(self.mktemp())
+        self.path.syncTo(fp)
+        stale = fp.child(b"file1")
+        stale.setContent(b"FILE 1")
+        os.utime(stale.path, (self.now, self.now))
+        os.utime(self.path.child(b"file1").path, (self.now, self.now))
+
+        self.path.syncTo(fp, checksum=True)
+
+        self.assertEqual(fp.child(b"file1").getContent(), self.f1content)
+
+    def test_syncToDelete(self):
+        """
+        L{FilePath.syncTo} only removes entries missing from the source when
+        C{delete} is set.
+        """
+        fp = filepath.FilePath(self.mktemp())
+        self.path.syncTo(fp)
+        fp.child(b"extra").setContent(b"extra")
+        fp.child(b"sub1").child(b"extra").createDirectory()
+
+        self.path.syncTo(fp)
+        self.assertTrue(fp.child(b"extra").exists())
+
+        self.path.syncTo(fp, delete=True)
+        self.assertFalse(fp.child(b"extra").exists())
+        self.assertFalse(fp.child(b"sub1").child(b"extra").exists())
+        self.assertTrue(fp.child(b"sub1").child(b"file2").exists())
+
+    def test_syncToReplacesKind(self):
+        """
+        L{FilePath.syncTo} replaces a destination entry of a different kind
+        than its source.
+        """
+        fp = filepath.FilePath(self.mktemp())
+        fp.createDirectory()
+        fp.child(b"sub1").setContent(b"not a directory")
+        fp.child(b"file1").createDirectory()
+
+        self.path.syncTo(fp)
+
+        self.assertTrue(fp.child(b"sub1").isdir())
+        self.assertEqual(fp.child(b"file1").getContent(), self.f1content)
+
+    def test_syncToMissingSource(self):
+        """
+        If the source path is missing, L{FilePath.syncTo} raises L{OSError}.
+        """
+        path = filepath.FilePath(self.mktemp())
+        exc = self.assertRaises(OSError, path.syncTo,
+                                filepath.FilePath(self.mktemp()))
+        self.assertEqual(exc.errno, errno.ENOENT)
+
     def test_moveTo(self):
         """
         Verify that moving an entire directory results into another directory
@@ -13,7 +13,7 @@
 # under the License.
 from unittest import TestCase
 
-from bp.util import modeIsWriting
+from bp.util import _OrderedDict, modeIsWriting, parallelMap
 
 
 class TestModeIsWriting(TestCase):
@@ -26,3 +26,56 @@ class TestModeIsWriting(TestCase):
 
     def test_aIsWriting(self):
         self.assertTrue(modeIsWriting("a"))
+
+
+class TestParallelMap(TestCase):
+
+    def test_serial(self):
+        self.assertEqual(parallelMap(abs, [-1, 2, -3]), [1, 2, 3])
+
+    def test_workersPreserveOrder(self):
+        items = range(-50, 50)
+        self.assertEqual(parallelMap(abs, items, workers=4), map(abs, items))
+
+
+class TestOrderedDict(TestCase):
+
+    def setUp(self):
+        self.d = _OrderedDict()
+        for key in "bca":
+            self.d[key] = key.upper()
+
+    def test_order(self):
+        self.assertEqual(list(self.d), ["b", "c", "a"])
+        self.assertEqual(list(self.d.iteritems()),
+                         [("b", "B"), ("c", "C"), ("a", "A")])
+
+    def test_replaceKeepsOrder(self):
+        self.d["c"] = "D"
+        self.assertEqual(list(self.d.iteritems()),
+                         [("b", "B"), ("c", "D"), ("a", "A")])
+
+    def test_popAndReinsert(self):
+        self.assertEqual(self.d.pop("b"), "B")
+        self.d["b"] = "B"
+        self.assertEqual(list(self.d), ["c", "a", "b"])
+
+    def test_popMissing(self):
+        self.assertEqual(self.d.pop("z", None), None)
+        self.assertRaises(KeyError, self.d.pop, "z")
+
+    def test_delete(self):
+        del self.d["c"]
+        self.assertEqual(list(self.d), ["b", "a"])
+        self.assertEqual(len(self.d), 2)
+
+    def test_popitem(self):
+        self.assertEqual(self.d.popitem(last=False), ("b", "B"))
+        self.assertEqual(self.d.popitem(), ("a", "A"))
+        self.assertEqual(list(self.d), ["c"])
+        self.d.popitem()
+        self.assertRaises(KeyError, self.d.popitem)
+
+    def test_copy(self):
+        self.assertEqual(list(_OrderedDict(self.d).iteritems()),
+                         list(self.d.iteritems()))
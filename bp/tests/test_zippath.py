@@ -18,11 +18,20 @@
 Test cases covering L{twisted.python.zippath}.
 """
 
+from array import array
 import os
+import shutil
+import tempfile
+import time
+from threading import Thread
 import zipfile
 
+from twisted.trial.unittest import SynchronousTestCase as TestCase
+
+from bp import zippath
+from bp.filepath import FilePath, InsecurePath
 from bp.tests.test_paths import AbstractFilePathTestCase
-from bp.zippath import ZipArchive
+from bp.zippath import ZipArchive, _CentralDirectory, _ZipIndex
 
 
 def zipit(dirname, zfname):
@@ -109,3 +118,454 @@ class ZipFilePathTestCase(AbstractFilePathTestCase):
 
         # Check using a path without the cwd prepended
         self.assertEqual(repr(relpath), pathRepr)
+
+    def test_readWithoutIndex(self):
+        """
+        Members can be found, measured and read without indexing the archive.
+        """
+        child = self.path.child("sub1").child("file2")
+        self.assertTrue(child.exists())
+        self.assertEqual(child.getsize(), len(self.f2content))
+        self.assertEqual(child.getContent(), self.f2content)
+        with child.open() as handle:
+            self.assertEqual(handle.read(), self.f2content)
+        self.assertIdentical(self.path._index, None)
+
+    def test_writable(self):
+        """
+        Archives opened for appending show the members written to them.
+        """
+        archive = ZipArchive(self.cmn + ".zip", "a")
+        archive.child("new").setContent("written")
+        self.assertTrue(archive.child("new").isfile())
+        self.assertEqual(archive.child("new").getsize(), 7)
+        self.assertEqual(archive.child("new").getContent(), "written")
+        self.assertTrue(archive.child("sub1").child("file2").isfile())
+
+    def test_indexOnListing(self):
+        """
+        Listing the archive indexes it, once.
+        """
+        self.path.listdir()
+        index = self.path._index
+        self.assertNotIdentical(index, None)
+        self.assertTrue(self.path.child("sub1").isdir())
+        self.assertIdentical(self.path._index, index)
+
+
+def childmap(names):
+    """
+    Build a map of every directory implied by some names in a zip archive to
+    its children, the straightforward way.
+    """
+    directories = {}
+    for name in names:
+        segments = name.split("/")
+        for i in range(len(segments)):
+            parent = "/".join(segments[:i])
+            directories.setdefault(parent, set()).add(segments[i])
+    return directories
+
+
+class ZipIndexTestCase(TestCase):
+    """
+    Tests for L{_ZipIndex}.
+    """
+
+    names = ["a/x", "a-b", "a.c", "a", "a/b/", "a/b/c/d", "a/y/z", "/abs",
+             "/abs/olute", "a//b", "e/", "f/g/h"]
+
+    def test_sameAsChildmap(self):
+        """
+        The index finds the same directories and children as a map of every
+        directory would.
+        """
+        index = _ZipIndex(self.names)
+        expected = childmap(self.names)
+        candidates = set(expected)
+        for name in self.names:
+            candidates.add(name)
+            candidates.add(name + "/")
+            candidates.add(name.rstrip("/"))
+        candidates.update(["missing", "a/missing", "a/b/c/d/e"])
+
+        for path in candidates:
+            self.assertEqual(index.isdir(path), path in expected, path)
+            if path in expected:
+                listing = index.listdir(path)
+                self.assertEqual(len(listing), len(set(listing)), path)
+                self.assertEqual(set(listing), expected[path], path)
+
+    def test_mixedNames(self):
+        """
+        Names may be a mix of L{str} with bytes outside of ASCII and
+        L{unicode}, as they are when only some of an archive's names are
+        flagged as UTF-8.
+        """
+        snowman = u"\N{SNOWMAN}"
+        index = _ZipIndex(["caf\xe9/x", snowman + u"/y", u"z", "\xff"])
+        self.assertEqual(set(index.listdir("")),
+                         set(["caf\xe9", snowman, u"z", "\xff"]))
+        self.assertEqual(index.listdir("caf\xe9"), ["x"])
+        self.assertEqual(index.listdir(snowman), [u"y"])
+        self.assertTrue(index.isdir(snowman))
+        self.assertTrue(index.isdir("caf\xe9"))
+        self.assertFalse(index.isdir(u"z"))
+
+    def test_mixedArchive(self):
+        """
+        Archives with a mix of L{str} and L{unicode} names can be listed and
+        walked.
+        """
+        temp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp)
+        filename = os.path.join(temp, "archive.zip")
+        zf = zipfile.ZipFile(filename, "w")
+        zf.writestr("caf\xe9/x", "x")
+        zf.writestr(u"\N{SNOWMAN}/y", "y")
+        zf.close()
+
+        archive = ZipArchive(filename)
+        self.assertEqual(set(archive.listdir()),
+                         set(["caf\xe9", u"\N{SNOWMAN}"]))
+        self.assertEqual(
+            sorted(path.getContent() for path in archive.walk()
+                   if path.isfile()),
+            ["x", "y"])
+
+    def test_empty(self):
+        """
+        An empty archive doesn't even have a root directory.
+        """
+        index = _ZipIndex([])
+        self.assertFalse(index.isdir(""))
+        self.assertEqual(index.listdir(""), [])
+
+
+class CentralDirectoryTestCase(TestCase):
+    """
+    Tests for L{_CentralDirectory}, which should find the same members as
+    L{zipfile.ZipFile}.
+    """
+
+    def setUp(self):
+        self.temp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp)
+        self.filename = os.path.join(self.temp, "archive.zip")
+
+    def assertSameMembers(self, filename):
+        directory = _CentralDirectory(filename)
+        zf = zipfile.ZipFile(filename)
+        self.assertEqual(directory.namelist(), zf.namelist())
+        for name in zf.namelist():
+            expected = zf.getinfo(name)
+            info = directory.getinfo(name)
+            for attribute in ("filename", "orig_filename", "date_time",
+                              "compress_type", "CRC", "compress_size",
+                              "file_size", "header_offset", "extra",
+                              "comment", "flag_bits", "external_attr"):
+                self.assertEqual(getattr(info, attribute),
+                                 getattr(expected, attribute))
+            self.assertIn(name, directory)
+            self.assertEqual(directory.getsize(name), expected.file_size)
+            self.assertEqual(directory.read(name), zf.read(name))
+
+    def test_members(self):
+        """
+        Stored and compressed members, directory entries, and names in UTF-8
+        are all found.
+        """
+        zf = zipfile.ZipFile(self.filename, "w", zipfile.ZIP_DEFLATED)
+        zf.writestr("a/b", "compressed " * 100)
+        zf.writestr(zipfile.ZipInfo("stored", (2001, 2, 3, 4, 5, 6)), "plain")
+        zf.writestr("empty/", "")
+        zf.writestr(u"\N{SNOWMAN}".encode("utf-8"), "snow")
+        zf.writestr(u"caf\N{LATIN SMALL LETTER E WITH ACUTE}", "unicode")
+        zf.comment = "a comment"
+        zf.close()
+        self.assertSameMembers(self.filename)
+
+    def test_prepended(self):
+        """
+        Archives with data in front of them, like self-extractors, are read
+        at the right offsets.
+        """
+        zf = zipfile.ZipFile(self.filename, "w")
+        zf.writestr("a", "alpha")
+        zf.close()
+        with open(self.filename, "rb") as handle:
+            archive = handle.read()
+        with open(self.filename, "wb") as handle:
+            handle.write("#!/bin/sh\nexit 0\n" + archive)
+        self.assertSameMembers(self.filename)
+
+    def test_zip64(self):
+        """
+        Archives with Zip64 end records are read.
+        """
+        zf = zipfile.ZipFile(self.filename, "w", allowZip64=True)
+        for i in range(0x10000):
+            zf.writestr("%d/%d" % (i % 10, i), "")
+        zf.close()
+        directory = _CentralDirectory(self.filename)
+        self.assertEqual(len(directory.namelist()), 0x10000)
+        self.assertEqual(directory.read("5/12345"), "")
+
+    def test_interleaved(self):
+        """
+        Members can be read a bit at a time, alternately.
+        """
+        zf = zipfile.ZipFile(self.filename, "w", zipfile.ZIP_DEFLATED)
+        zf.writestr("a", "a" * 100000)
+        zf.writestr("b", os.urandom(100000))
+        zf.close()
+        directory = _CentralDirectory(self.filename)
+        a, b = directory.open("a"), directory.open("b")
+        pieces = {"a": [], "b": []}
+        for i in range(100):
+            pieces["a"].append(a.read(1000))
+            pieces["b"].append(b.read(1000))
+        a.close()
+        b.close()
+        zf = zipfile.ZipFile(self.filename)
+        self.assertEqual("".join(pieces["a"]), zf.read("a"))
+        self.assertEqual("".join(pieces["b"]), zf.read("b"))
+
+    def test_threads(self):
+        """
+        Members can be read from many threads at once.
+        """
+        zf = zipfile.ZipFile(self.filename, "w", zipfile.ZIP_DEFLATED)
+        for i in range(32):
+            zf.writestr("%d" % i, ("%d" % i) * 10000)
+        zf.close()
+        archive = ZipArchive(self.filename)
+        results = {}
+
+        def read(i):
+            for j in range(32):
+                name = "%d" % ((i + j) % 32)
+                results[i, name] = archive.child(name).getContent()
+
+        threads = [Thread(target=read, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), 8 * 32)
+        for (i, name), content in results.items():
+            self.assertEqual(content, name * 10000)
+
+    def test_notAZip(self):
+        """
+        Anything which isn't a zip archive is rejected.
+        """
+        with open(self.filename, "wb") as handle:
+            handle.write("not a zip file" * 10)
+        self.assertRaises(zipfile.BadZipfile, _CentralDirectory,
+                          self.filename)
+
+    def test_missing(self):
+        """
+        Missing members can't be found.
+        """
+        zf = zipfile.ZipFile(self.filename, "w")
+        zf.writestr("a", "alpha")
+        zf.close()
+        directory = _CentralDirectory(self.filename)
+        self.assertNotIn("b", directory)
+        self.assertRaises(KeyError, directory.getinfo, "b")
+        self.assertRaises(KeyError, directory.open, "b")
+
+
+class IndexCacheTestCase(TestCase):
+    """
+    Tests for caching the index of a L{_CentralDirectory}.
+    """
+
+    def setUp(self):
+        self.temp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp)
+        self.filename = os.path.join(self.temp, "archive.zip")
+        self.cache = FilePath(self.temp).child("cache")
+        self.cache.createDirectory()
+        self.writeArchive(["b/c", "a",
+                           u"caf\N{LATIN SMALL LETTER E WITH ACUTE}"])
+
+    def writeArchive(self, names):
+        zf = zipfile.ZipFile(self.filename, "w", zipfile.ZIP_DEFLATED)
+        for name in names:
+            zf.writestr(name, "contents of %r" % (name,))
+        zf.close()
+
+    def test_created(self):
+        """
+        Reading an archive caches its index.
+        """
+        _CentralDirectory(self.filename, self.cache)
+        self.assertEqual(len(self.cache.children()), 1)
+
+    def test_loaded(self):
+        """
+        An archive whose index is cached has the same members as when it was
+        read.
+        """
+        parsed = _CentralDirectory(self.filename, self.cache)
+        loaded = _CentralDirectory(self.filename, self.cache)
+        self.assertNotIdentical(loaded._order, None)
+        self.assertEqual(loaded.namelist(), parsed.namelist())
+        self.assertEqual(loaded.sortedNames(), sorted(parsed.namelist()))
+        for name in parsed.namelist():
+            self.assertEqual(loaded.read(name), parsed.read(name))
+            self.assertEqual(loaded.getinfo(name).header_offset,
+                             parsed.getinfo(name).header_offset)
+
+    def test_unicode(self):
+        """
+        Unicode names are still unicode once loaded from the cache.
+        """
+        _CentralDirectory(self.filename, self.cache)
+        loaded = _CentralDirectory(self.filename, self.cache)
+        name = u"caf\N{LATIN SMALL LETTER E WITH ACUTE}"
+        self.assertIn(name, loaded)
+        self.assertEqual([n for n in loaded.namelist()
+                          if isinstance(n, unicode)], [name])
+
+    def test_mixedNames(self):
+        """
+        Archives with a mix of L{str} names with bytes outside of ASCII and
+        L{unicode} names can be cached.
+        """
+        self.writeArchive(["caf\xe9/x", u"\N{SNOWMAN}/y"])
+        ZipArchive(self.filename, indexCache=self.cache)
+        archive = ZipArchive(self.filename, indexCache=self.cache)
+        self.assertNotIdentical(archive.members._order, None)
+        self.assertEqual(archive.members.sortedNames(),
+                         ["caf\xe9/x", u"\N{SNOWMAN}/y"])
+        self.assertEqual(set(archive.listdir()),
+                         set(["caf\xe9", u"\N{SNOWMAN}"]))
+
+    def test_wide(self):
+        """
+        Sizes and offsets are kept in arrays wide enough for Zip64 archives.
+        """
+        self.assertEqual(array(zippath._WIDE, [2 ** 53]).tolist(), [2 ** 53])
+
+    def test_doubles(self):
+        """
+        Where unsigned longs are too narrow for Zip64 sizes and offsets, they
+        are kept as doubles, both in memory and in the cache, but still
+        given out as integers.
+        """
+        parsed = _CentralDirectory(self.filename, self.cache)
+        self.patch(zippath, "_WIDE", "d")
+        doubles = _CentralDirectory(self.filename, self.cache)
+        loaded = _CentralDirectory(self.filename, self.cache)
+        for directory in doubles, loaded:
+            self.assertEqual(directory._sizes.typecode, "d")
+            for name in parsed.namelist():
+                size = directory.getsize(name)
+                self.assertEqual(size, parsed.getsize(name))
+                self.assertIsInstance(size, (int, long))
+                self.assertEqual(directory.read(name), parsed.read(name))
+
+    def test_invalidated(self):
+        """
+        Changing the archive means its cached index isn't used.
+        """
+        _CentralDirectory(self.filename, self.cache)
+        self.writeArchive(["x", "y/z"])
+        directory = _CentralDirectory(self.filename, self.cache)
+        self.assertEqual(directory.namelist(), ["x", "y/z"])
+        self.assertEqual(directory.read("y/z"), "contents of 'y/z'")
+
+    def test_corrupt(self):
+        """
+        A corrupt cache is ignored and replaced.
+        """
+        _CentralDirectory(self.filename, self.cache)
+        cacheFile, = self.cache.children()
+        cacheFile.setContent("garbage")
+        directory = _CentralDirectory(self.filename, self.cache)
+        self.assertEqual(sorted(directory.namelist()),
+                         sorted(zipfile.ZipFile(self.filename).namelist()))
+        self.assertNotEqual(cacheFile.getContent(), "garbage")
+
+    def test_archive(self):
+        """
+        L{ZipArchive} passes its index cache along.
+        """
+        ZipArchive(self.filename, indexCache=self.cache)
+        archive = ZipArchive(self.filename, indexCache=self.cache)
+        self.assertNotIdentical(archive.members._order, None)
+        self.assertEqual(sorted(archive.listdir()), ["a", "b", u"caf\xe9"])
+
+
+class ExtractToTestCase(TestCase):
+    """
+    Tests for L{ZipArchive.extractTo}.
+    """
+
+    def setUp(self):
+        self.temp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp)
+        self.filename = os.path.join(self.temp, "archive.zip")
+        self.target = FilePath(self.temp).child("target")
+
+    def writeArchive(self, members):
+        zf = zipfile.ZipFile(self.filename, "w", zipfile.ZIP_DEFLATED)
+        for name, content in members:
+            zf.writestr(zipfile.ZipInfo(name, (2001, 2, 3, 4, 5, 6)), content)
+        zf.close()
+
+    def test_tree(self):
+        """
+        Files and directories, including empty and implied ones, are all
+        extracted, with the modification times recorded in the archive.
+        """
+        big = os.urandom(300000)
+        self.writeArchive([("a/b/c", "abc"), ("a/d", big), ("e/", ""),
+                           ("f", "f")])
+        ZipArchive(self.filename).extractTo(self.target, workers=4)
+        self.assertEqual(self.target.descendant(["a", "b", "c"]).getContent(),
+                         "abc")
+        self.assertEqual(self.target.descendant(["a", "d"]).getContent(), big)
+        self.assertEqual(self.target.child("f").getContent(), "f")
+        self.assertEqual(self.target.child("e").listdir(), [])
+        mtime = time.mktime((2001, 2, 3, 4, 5, 6, 0, 0, 0))
+        for path in (["a", "d"], ["e"], ["f"]):
+            self.assertEqual(
+                self.target.descendant(path).getModificationTime(), mtime)
+
+    def test_serial(self):
+        """
+        A single worker extracts the same tree.
+        """
+        members = [("%d/%d" % (i % 3, i), "%d" % i) for i in range(20)]
+        self.writeArchive(members)
+        ZipArchive(self.filename).extractTo(self.target)
+        for name, content in members:
+            path = self.target.descendant(name.split("/"))
+            self.assertEqual(path.getContent(), content)
+
+    def test_existing(self):
+        """
+        Extracting into an existing directory overwrites files in the way.
+        """
+        self.writeArchive([("a/b", "new")])
+        self.target.child("a").makedirs()
+        self.target.descendant(["a", "b"]).setContent("old")
+        ZipArchive(self.filename).extractTo(self.target, workers=2)
+        self.assertEqual(self.target.descendant(["a", "b"]).getContent(),
+                         "new")
+
+    def test_insecure(self):
+        """
+        Nothing is extracted from archives with members outside of the
+        target.
+        """
+        self.writeArchive([("a", "a"), ("../escaped", "b")])
+        self.assertRaises(InsecurePath, ZipArchive(self.filename).extractTo,
+                          self.target)
+        self.assertFalse(self.target.exists())
+        self.assertFalse(FilePath(self.temp).child("escaped").exists())
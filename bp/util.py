@@ -11,6 +11,75 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
+import errno
+from multiprocessing.pool import ThreadPool
+import os
+
+
+class _OrderedDict(dict):
+    """
+    A dictionary which remembers the order in which its keys were added.
+
+    This stands in for L{collections.OrderedDict}, which Python 2.6 lacks,
+    and only supports the parts of it which this package uses.
+    """
+
+    def __init__(self, items=()):
+        dict.__init__(self)
+        # Keys are kept in a circular doubly linked list of [previous, next,
+        # key] links, so that any key can be removed in constant time.
+        self._root = root = []
+        root[:] = [root, root, None]
+        self._links = {}
+        if hasattr(items, "iteritems"):
+            items = items.iteritems()
+        for key, value in items:
+            self[key] = value
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            root = self._root
+            last = root[0]
+            last[1] = root[0] = self._links[key] = [last, root, key]
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        previous, following, key = self._links.pop(key)
+        previous[1] = following
+        following[0] = previous
+
+    def __iter__(self):
+        root = self._root
+        link = root[1]
+        while link is not root:
+            yield link[2]
+            link = link[1]
+
+    def iteritems(self):
+        for key in self:
+            yield key, self[key]
+
+    def pop(self, key, *default):
+        if key in self:
+            value = self[key]
+            del self[key]
+            return value
+        return dict.pop(self, key, *default)
+
+    def popitem(self, last=True):
+        if not self:
+            raise KeyError("dictionary is empty")
+        key = self._root[0 if last else 1][2]
+        return key, self.pop(key)
+
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    OrderedDict = _OrderedDict
+
+
 def modeIsWriting(mode):
     """
     Determine whether a file mode will permit writing.
@@ -18,3 +87,61 @@ def modeIsWriting(mode):
 
     m = mode.lower()
     return m not in ("r", "rb", "ru", "rub")
+
+
+def encodeName(name):
+    """
+    Encode a name as UTF-8 if it is L{unicode}.
+
+    L{str} and L{unicode} names can't be compared once they have bytes
+    outside of ASCII, but their encoded forms can, and sort the same way.
+
+    :param name: A L{str} or L{unicode} name.
+    :rtype: L{str}
+    """
+
+    if isinstance(name, unicode):
+        return name.encode("utf-8")
+    return name
+
+
+def ensureDirectory(path):
+    """
+    Create a directory, unless it already exists.
+
+    :param bytes path: The path of the directory.
+    """
+
+    try:
+        os.mkdir(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def parallelMap(f, items, workers=1):
+    """
+    Apply a function to every item in a sequence, possibly on a pool of
+    threads.
+
+    With a single worker, or with fewer than two items, no threads are
+    started and the items are simply mapped in order.
+
+    :param callable f: A one-argument callable.
+    :param items: A sequence of arguments for C{f}.
+    :param int workers: The number of threads to spread the work across.
+
+    :return: A list of the results, in the same order as C{items}.
+    :rtype: list
+    """
+
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        return [f(item) for item in items]
+
+    pool = ThreadPool(min(workers, len(items)))
+    try:
+        return pool.map(f, items)
+    finally:
+        pool.close()
+        pool.join()
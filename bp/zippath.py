@@ -22,9 +22,22 @@ See the constructor for ZipArchive for use.
 
 __metaclass__ = type
 
+from array import array
+from bisect import bisect_left
+from contextlib import closing
+from hashlib import sha1
+from itertools import izip
+import mmap
 import os
+import struct
+import sys
+from threading import Lock
 import time
-from zipfile import ZipFile
+from zipfile import (BadZipfile, ZipExtFile, ZipFile, ZipInfo, _EndRecData,
+                     _ECD_LOCATION, _ECD_OFFSET, _ECD_SIGNATURE, _ECD_SIZE,
+                     sizeEndCentDir64, sizeEndCentDir64Locator,
+                     stringCentralDir, stringEndArchive64, stringFileHeader,
+                     structCentralDir, structFileHeader)
 
 from zope.interface import implementer
 
@@ -33,6 +46,7 @@ from bp.errors import UnlistableError
 from bp.filepath import FilePath
 from bp.generic import (genericChildren, genericDescendant, genericParents,
                         genericSegmentsFrom, genericSibling, genericWalk)
+from bp.util import encodeName, ensureDirectory, parallelMap
 
 # using FilePath here exclusively rather than os to make sure that we don't do
 # anything OS-path-specific here.
@@ -40,6 +54,442 @@ from bp.generic import (genericChildren, genericDescendant, genericParents,
 ZIP_PATH_SEP = '/'              # In zipfiles, "/" is universally used as the
                                 # path separator, regardless of platform.
 
+# The character sorting immediately after ZIP_PATH_SEP.
+_AFTER_SEP = chr(ord(ZIP_PATH_SEP) + 1)
+
+# How much of a member is decompressed at a time when extracting it.
+_CHUNK_SIZE = 64 * 1024
+
+
+class _ZipIndex(object):
+    """
+    The directory structure implied by the names in a zip archive.
+
+    Every prefix of a name, up to any separator, is a directory, and the
+    root is a directory as long as there are any names at all. Rather than
+    building a table of directories, the names are simply kept sorted, so
+    that everything beneath a directory is found by binary search. They are
+    searched by their keys, as made by L{encodeName}.
+    """
+
+    def __init__(self, names):
+        # Sorting takes linear time if the names are already sorted.
+        self.names = sorted(names, key=encodeName)
+        self.keys = [encodeName(name) for name in self.names]
+
+    def isdir(self, path):
+        if not path:
+            return bool(self.names)
+        prefix = encodeName(path) + ZIP_PATH_SEP
+        i = bisect_left(self.keys, prefix)
+        return i < len(self.keys) and self.keys[i].startswith(prefix)
+
+    def listdir(self, path):
+        """
+        List the names of the children of a directory.
+
+        Whole subdirectories are skipped over by binary search, so this takes
+        time proportional to the number of children, rather than to the
+        number of names beneath the directory.
+        """
+
+        names, keys = self.names, self.keys
+        children = []
+        if path:
+            prefixes = [encodeName(path) + ZIP_PATH_SEP]
+        else:
+            # The first segment of every name is a child of the root, but so
+            # is the second segment of a name with an empty first segment.
+            prefixes = ["", ZIP_PATH_SEP]
+
+        for prefix in prefixes:
+            i = bisect_left(keys, prefix)
+            while i < len(keys) and keys[i].startswith(prefix):
+                rest = keys[i][len(prefix):]
+                child, sep, ignored = rest.partition(ZIP_PATH_SEP)
+                if isinstance(names[i], unicode):
+                    children.append(child.decode("utf-8"))
+                else:
+                    children.append(child)
+                if sep:
+                    i = bisect_left(keys, prefix + child + _AFTER_SEP, i)
+                else:
+                    i += 1
+        return list(_unique(children))
+
+
+_CENTRAL_DIR = struct.Struct(structCentralDir)
+_FILE_HEADER = struct.Struct(structFileHeader)
+# Sizes and offsets which are too large for a central directory record, and
+# are given in its Zip64 extra field instead.
+_ZIP64_MARKER = 0xffffffff
+
+# The layout of a cached index: a header identifying the archive it was made
+# from, then the names of the members, and then the member table, the order
+# the names sort in, and which names are unicode, as raw arrays.
+_CACHE_MAGIC = b"BPZIDX2\0"
+_CACHE_HEADER = struct.Struct("<8scBQdQQqQQQ")
+
+# Sizes and offsets may need all 64 bits in a Zip64 archive, but unsigned
+# longs only have 32 of them on Windows and 32-bit platforms. Doubles hold
+# integers exactly up to 2 ** 53, far beyond any archive.
+_WIDE = "L" if array("L").itemsize >= 8 else "d"
+
+
+class _CentralDirectory(object):
+    """
+    The members of a zip archive, read straight from its central directory.
+
+    This reads archives just like L{ZipFile} does, but rather than making a
+    L{ZipInfo} for every member up front, it maps the central directory and
+    keeps only what is needed to find and measure members, in arrays
+    alongside a list of names. A L{ZipInfo} is only made for a member when
+    it is opened or otherwise asked for.
+
+    All of this may also be cached in a directory, in a file per archive,
+    which is used for as long as the archive's size, modification time and
+    central directory stay the same.
+    """
+
+    def __init__(self, filename, cache=None):
+        self.filename = filename
+        with open(filename, "rb") as handle:
+            try:
+                endrec = _EndRecData(handle)
+            except IOError:
+                raise BadZipfile("File is not a zip file")
+            if not endrec:
+                raise BadZipfile("File is not a zip file")
+
+            size = endrec[_ECD_SIZE]
+            # Anything before the archive proper, such as a self-extractor,
+            # shifts every offset in it.
+            self._concat = endrec[_ECD_LOCATION] - size - endrec[_ECD_OFFSET]
+            if endrec[_ECD_SIGNATURE] == stringEndArchive64:
+                self._concat -= sizeEndCentDir64 + sizeEndCentDir64Locator
+            start = endrec[_ECD_OFFSET] + self._concat
+            self._map = mmap.mmap(handle.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+            st = os.fstat(handle.fileno())
+
+        # The order in which the names sort, if it's known.
+        self._order = None
+
+        if cache is None:
+            self._parse(start, size)
+            return
+
+        key = st.st_size, st.st_mtime, start, size
+        path = os.path.abspath(filename)
+        if isinstance(path, unicode):
+            path = path.encode("utf-8")
+        cacheFile = cache.child(sha1(path).hexdigest())
+        if not self._loadCache(cacheFile, key):
+            self._parse(start, size)
+            self._saveCache(cacheFile, key)
+
+    def _parse(self, start, size):
+        """
+        Read the central directory.
+        """
+
+        # The position of each member's central directory record, and its
+        # size, CRC and where its data begins.
+        self._records = array(_WIDE)
+        self._sizes = array(_WIDE)
+        self._crcs = array("L")
+        self._offsets = array(_WIDE)
+        self._names = []
+        self._positions = {}
+
+        data = self._map
+        unpack = _CENTRAL_DIR.unpack_from
+        position = start
+        end = start + size
+        while position < end:
+            if position + _CENTRAL_DIR.size > end:
+                raise BadZipfile("Truncated central directory")
+            record = unpack(data, position)
+            if record[0] != stringCentralDir:
+                raise BadZipfile("Bad magic number for central directory")
+            nameStart = position + _CENTRAL_DIR.size
+            name = self._decodeName(data[nameStart:nameStart + record[12]],
+                                    record[5])
+
+            fileSize = record[11]
+            offset = record[18]
+            if _ZIP64_MARKER in (record[10], fileSize, offset):
+                info = self._makeInfo(position)
+                fileSize = info.file_size
+                offset = info.header_offset
+            else:
+                offset += self._concat
+
+            self._positions[name] = len(self._names)
+            self._names.append(name)
+            self._records.append(position)
+            self._sizes.append(fileSize)
+            self._crcs.append(record[9])
+            self._offsets.append(offset)
+            position = nameStart + record[12] + record[13] + record[14]
+
+    def _loadCache(self, cacheFile, key):
+        """
+        Load a cached index, if there is one for this version of the archive.
+
+        :return: Whether the index was loaded.
+        """
+
+        try:
+            with cacheFile.open("rb") as handle:
+                data = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        except (EnvironmentError, ValueError):
+            return False
+
+        try:
+            return self._readCache(data, key)
+        except (IndexError, ValueError, struct.error):
+            return False
+        finally:
+            data.close()
+
+    def _readCache(self, data, key):
+        """
+        Read a cached index from its bytes.
+        """
+
+        header = _CACHE_HEADER.unpack_from(data)
+        (magic, wide, itemsize, size, mtime, start, cdSize, concat, count,
+         unicodeCount, namesLength) = header
+        if (magic != _CACHE_MAGIC or wide != _WIDE
+            or itemsize != array("L").itemsize
+            or (size, mtime, start, cdSize) != key):
+            return False
+
+        position = _CACHE_HEADER.size
+        names = data[position:position + namesLength].split(b"\0")
+        position += namesLength
+        tables = []
+        for typecode, length in [(_WIDE, count), (_WIDE, count), ("L", count),
+                                 (_WIDE, count), ("L", count),
+                                 ("L", unicodeCount)]:
+            table = array(typecode)
+            end = position + length * table.itemsize
+            table.fromstring(data[position:end])
+            position = end
+            tables.append(table)
+        if not count:
+            names = []
+        if position != len(data) or len(names) != count:
+            return False
+        for i in tables[5]:
+            names[i] = names[i].decode("utf-8")
+
+        (self._records, self._sizes, self._crcs, self._offsets,
+         self._order) = tables[:5]
+        self._concat = concat
+        self._names = names
+        self._positions = dict(izip(names, xrange(count)))
+        return True
+
+    def _saveCache(self, cacheFile, key):
+        """
+        Cache the index of this version of the archive. Failing to do so
+        isn't fatal, since the archive has been read anyway.
+        """
+
+        names = self._names
+        self._order = array("L", sorted(
+            xrange(len(names)), key=lambda i: encodeName(names[i])))
+        unicodes = array("L", (i for i, name in enumerate(names)
+                               if isinstance(name, unicode)))
+        encoded = b"\0".join(encodeName(name) for name in names)
+        header = _CACHE_HEADER.pack(_CACHE_MAGIC, _WIDE, unicodes.itemsize,
+                                    key[0], key[1], key[2], key[3],
+                                    self._concat, len(names), len(unicodes),
+                                    len(encoded))
+        tables = [self._records, self._sizes, self._crcs, self._offsets,
+                  self._order, unicodes]
+        content = b"".join([header, encoded] +
+                           [table.tostring() for table in tables])
+        try:
+            cacheFile.setContent(content)
+        except EnvironmentError:
+            pass
+
+    def _decodeName(self, name, flags):
+        """
+        Turn a name from a central directory record into a member name, the
+        same way L{ZipInfo} does.
+        """
+        null = name.find(chr(0))
+        if null >= 0:
+            name = name[:null]
+        if os.sep != ZIP_PATH_SEP and os.sep in name:
+            name = name.replace(os.sep, ZIP_PATH_SEP)
+        if flags & 0x800:
+            name = name.decode("utf-8")
+        return name
+
+    def _makeInfo(self, position):
+        """
+        Make a L{ZipInfo} from the central directory record at a position,
+        exactly as L{ZipFile} would have.
+        """
+        data = self._map
+        record = _CENTRAL_DIR.unpack_from(data, position)
+        position += _CENTRAL_DIR.size
+        info = ZipInfo(data[position:position + record[12]])
+        position += record[12]
+        info.extra = data[position:position + record[13]]
+        position += record[13]
+        info.comment = data[position:position + record[14]]
+        info.header_offset = record[18]
+        (info.create_version, info.create_system, info.extract_version,
+         info.reserved, info.flag_bits, info.compress_type, t, d,
+         info.CRC, info.compress_size, info.file_size) = record[1:12]
+        info.volume, info.internal_attr, info.external_attr = record[15:18]
+        info._raw_time = t
+        info.date_time = ((d >> 9) + 1980, (d >> 5) & 0xf, d & 0x1f,
+                          t >> 11, (t >> 5) & 0x3f, (t & 0x1f) * 2)
+        info._decodeExtra()
+        info.header_offset += self._concat
+        info.filename = info._decodeFilename()
+        return info
+
+    def __contains__(self, name):
+        return name in self._positions
+
+    def namelist(self):
+        return list(self._names)
+
+    def sortedNames(self):
+        """
+        List the names of the members in sorted order.
+        """
+        if self._order is None:
+            return sorted(self._names, key=encodeName)
+        names = self._names
+        return [names[i] for i in self._order]
+
+    def getinfo(self, name):
+        try:
+            return self._makeInfo(
+                int(self._records[self._positions[name]]))
+        except KeyError:
+            raise KeyError(
+                "There is no item named %r in the archive" % (name,))
+
+    def getsize(self, name):
+        return int(self._sizes[self._positions[name]])
+
+    def open(self, name, mode="r"):
+        if mode not in ("r", "U", "rU"):
+            raise RuntimeError('open() requires mode "r", "U", or "rU"')
+        info = self.getinfo(name)
+        if info.flag_bits & 0x1:
+            raise RuntimeError("File %s is encrypted, password required for "
+                               "extraction" % (name,))
+
+        # Members are read straight out of the map, rather than through a
+        # file with a single position, so that any number of them may be
+        # read at once, from any number of threads.
+        position = info.header_offset
+        header = self._map[position:position + _FILE_HEADER.size]
+        if len(header) != _FILE_HEADER.size:
+            raise BadZipfile("Truncated file header")
+        header = _FILE_HEADER.unpack(header)
+        if header[0] != stringFileHeader:
+            raise BadZipfile("Bad magic number for file header")
+        position += _FILE_HEADER.size
+        headerName = self._map[position:position + header[10]]
+        if headerName != info.orig_filename:
+            raise BadZipfile(
+                'File name in directory "%s" and header "%s" differ.'
+                % (info.orig_filename, headerName))
+        position += header[10] + header[11]
+        return _extFile(_MappedReader(self._map, position), mode, info)
+
+    def read(self, name):
+        handle = self.open(name)
+        try:
+            return handle.read()
+        finally:
+            handle.close()
+
+
+if sys.version_info < (2, 7):
+    def _extFile(reader, mode, info):
+        handle = ZipExtFile(reader, info)
+        if "U" in mode:
+            handle.set_univ_newlines(True)
+        return handle
+else:
+    def _extFile(reader, mode, info):
+        return ZipExtFile(reader, mode, info, close_fileobj=True)
+
+
+class _MappedReader(object):
+    """
+    A file-like object reading from a map, starting at some position, which
+    keeps a position of its own.
+    """
+
+    def __init__(self, data, position):
+        self._data = data
+        self._position = position
+
+    def read(self, size):
+        start = self._position
+        self._position += size
+        return self._data[start:self._position]
+
+    def close(self):
+        self._data = None
+
+
+class _ZipFileMembers(object):
+    """
+    The members of a zip archive, as found by a L{ZipFile}, which keeps
+    track of members written to it.
+    """
+
+    def __init__(self, zipfile):
+        self.zipfile = zipfile
+
+    def __contains__(self, name):
+        return name in self.zipfile.NameToInfo
+
+    def namelist(self):
+        return self.zipfile.namelist()
+
+    def sortedNames(self):
+        return sorted(self.zipfile.namelist(), key=encodeName)
+
+    def getinfo(self, name):
+        return self.zipfile.getinfo(name)
+
+    def getsize(self, name):
+        return self.zipfile.NameToInfo[name].file_size
+
+    def open(self, name, mode="r"):
+        return self.zipfile.open(name, mode=mode)
+
+    def read(self, name):
+        return self.zipfile.read(name)
+
+
+def _unique(items):
+    """
+    Yield each distinct item once, in order.
+    """
+
+    seen = set()
+    for item in items:
+        if item not in seen:
+            seen.add(item)
+            yield item
+
 
 @implementer(IFilePath)
 class ZipPath(object):
@@ -61,7 +511,7 @@ class ZipPath(object):
         self.pathInArchive = pathInArchive
         # self.path pretends to be os-specific because that's the way the
         # 'zipimport' module does it.
-        self.path = os.path.join(archive.zipfile.filename,
+        self.path = os.path.join(archive.path,
                                  *(self.pathInArchive.split(ZIP_PATH_SEP)))
 
     def __cmp__(self, other):
@@ -118,14 +568,14 @@ class ZipPath(object):
     # IFilePath writing and reading
 
     def open(self, mode="r"):
-        return self.archive.zipfile.open(self.pathInArchive, mode=mode)
+        return self.archive.members.open(self.pathInArchive, mode=mode)
 
     def createDirectory(self):
         # No-op; there's nothing to do.
         pass
 
     def getContent(self):
-        return self.archive.zipfile.read(self.pathInArchive)
+        return self.archive.members.read(self.pathInArchive)
 
     def setContent(self, content, ext=b'.new'):
         self.archive.zipfile.writestr(self.pathInArchive, content)
@@ -133,13 +583,13 @@ class ZipPath(object):
     # IFilePath stat and other queries
 
     def exists(self):
-        return self.isdir() or self.isfile()
+        return self.isfile() or self.isdir()
 
     def isdir(self):
-        return self.pathInArchive in self.archive.childmap
+        return self.archive.index.isdir(self.pathInArchive)
 
     def isfile(self):
-        return self.pathInArchive in self.archive.zipfile.NameToInfo
+        return self.pathInArchive in self.archive.members
 
     def islink(self):
         return False
@@ -147,7 +597,7 @@ class ZipPath(object):
     def listdir(self):
         if self.exists():
             if self.isdir():
-                return self.archive.childmap[self.pathInArchive].keys()
+                return self.archive.index.listdir(self.pathInArchive)
             else:
                 raise UnlistableError("Leaf zip entry listed")
         else:
@@ -184,7 +634,7 @@ class ZipPath(object):
         @return: file size, in bytes
         """
 
-        return self.archive.zipfile.NameToInfo[self.pathInArchive].file_size
+        return self.archive.members.getsize(self.pathInArchive)
 
     def getAccessTime(self):
         """
@@ -207,7 +657,7 @@ class ZipPath(object):
         :rtype: int
         """
         return time.mktime(
-            self.archive.zipfile.NameToInfo[self.pathInArchive].date_time
+            self.archive.members.getinfo(self.pathInArchive).date_time
             + (0, 0, 0))
 
     # ZIP archives have no independent notion of ctime, so mtime is used for
@@ -223,32 +673,57 @@ class ZipArchive(ZipPath):
 
     archive = property(lambda self: self)
 
-    def __init__(self, archivePathname, mode="r"):
+    def __init__(self, archivePathname, mode="r", indexCache=None):
         """
         Create a ZipArchive, treating the archive at archivePathname as a zip
         file.
 
+        Archives opened for reading have their central directory read
+        directly, without making a L{ZipInfo} for each member; a L{ZipFile}
+        is only made for them if the C{zipfile} attribute is used. Their
+        members may be read from many threads at once.
+
         :param str archivePathname: A path in the filesystem.
         :param str mode: A file mode which can be "r" for reading, "w" for
                          truncating and writing, or "a" for appending and
                          writing.
+        :param FilePath indexCache: A directory in which to cache the index
+                                    of an archive opened for reading, so that
+                                    it need only be read once for as long as
+                                    the archive doesn't change.
         """
-        self.zipfile = ZipFile(archivePathname, mode)
         self.path = archivePathname
         self.pathInArchive = ''
-        # zipfile is already wasting O(N) memory on cached ZipInfo instances,
-        # so there's no sense in trying to do this lazily or intelligently
-        self.childmap = {}      # map parent: list of children
-
-        for name in self.zipfile.namelist():
-            name = name.split(ZIP_PATH_SEP)
-            for x in range(len(name)):
-                child = name[-x]
-                parent = ZIP_PATH_SEP.join(name[:-x])
-                if parent not in self.childmap:
-                    self.childmap[parent] = {}
-                self.childmap[parent][child] = 1
-            parent = ''
+        self._index = None
+        self._lock = Lock()
+        if mode == "r":
+            self._zipfile = None
+            self.members = _CentralDirectory(archivePathname, indexCache)
+        else:
+            self._zipfile = ZipFile(archivePathname, mode)
+            self.members = _ZipFileMembers(self._zipfile)
+
+    @property
+    def zipfile(self):
+        """
+        A L{ZipFile} for the archive.
+        """
+        with self._lock:
+            if self._zipfile is None:
+                self._zipfile = ZipFile(self.path)
+        return self._zipfile
+
+    @property
+    def index(self):
+        """
+        The directory structure of the archive, which is only worked out
+        once something needs it. Reading a member whose name is already known
+        never does.
+        """
+        with self._lock:
+            if self._index is None:
+                self._index = _ZipIndex(self.members.sortedNames())
+        return self._index
 
     def child(self, path):
         """
@@ -263,25 +738,92 @@ class ZipArchive(ZipPath):
         """
         Returns whether the underlying archive exists.
         """
-        return FilePath(self.zipfile.filename).exists()
+        return FilePath(self.path).exists()
 
     def getAccessTime(self):
         """
         Return the archive file's last access time.
         """
-        return FilePath(self.zipfile.filename).getAccessTime()
+        return FilePath(self.path).getAccessTime()
 
     def getModificationTime(self):
         """
         Return the archive file's modification time.
         """
-        return FilePath(self.zipfile.filename).getModificationTime()
+        return FilePath(self.path).getModificationTime()
 
     def getStatusChangeTime(self):
         """
         Return the archive file's status change time.
         """
-        return FilePath(self.zipfile.filename).getStatusChangeTime()
+        return FilePath(self.path).getStatusChangeTime()
+
+    def extractTo(self, filePath, workers=1):
+        """
+        Extract every member of the archive into a directory on disk, which
+        is created if it doesn't exist.
+
+        The directories are all made first, from the names of the members,
+        and the files are then decompressed on a pool of threads, a chunk at
+        a time. Files and directories get the modification times recorded
+        for them in the archive. Existing files in the way are overwritten.
+
+        Nothing is extracted from an archive with a member whose name would
+        put it outside of C{filePath}.
+
+        :param FilePath filePath: The directory to extract into.
+        :param int workers: The number of threads to decompress files with.
+
+        :raises InsecurePath: If a member's name isn't a safe relative path.
+        """
+
+        members = self.members
+        directories = {(): None}
+        files = []
+        for name in members.sortedNames():
+            segments = name
+            if isinstance(name, unicode) and not isinstance(filePath.path,
+                                                            unicode):
+                segments = name.encode("utf-8")
+            segments = [segment for segment in segments.split(ZIP_PATH_SEP)
+                        if segment]
+            target = genericDescendant(filePath, segments)
+            if name.endswith(ZIP_PATH_SEP):
+                directories[tuple(segments)] = name, target
+            else:
+                files.append((name, target))
+            segments = segments[:-1]
+            while tuple(segments) not in directories:
+                directories[tuple(segments)] = None
+                segments = segments[:-1]
+
+        for segments in sorted(directories, key=len):
+            ensureDirectory(genericDescendant(filePath, segments).path)
+
+        def extract(item):
+            name, target = item
+            # Members aren't context managers on Python 2.6.
+            with closing(members.open(name)) as source:
+                with open(target.path, "wb") as handle:
+                    while True:
+                        chunk = source.read(_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        handle.write(chunk)
+            setTime(name, target)
+
+        def setTime(name, target):
+            mtime = time.mktime(members.getinfo(name).date_time
+                                + (0, 0, 0))
+            os.utime(target.path, (mtime, mtime))
+
+        parallelMap(extract, files, workers)
+
+        # Adding files to a directory changes its modification time, so
+        # directories are done last, from the deepest up.
+        for segments in sorted(directories, key=len, reverse=True):
+            if directories[segments] is not None:
+                setTime(*directories[segments])
 
     def __repr__(self):
         return 'ZipArchive(%r)' % (os.path.abspath(self.path),)